@@ -1,9 +1,17 @@
 import os
+import csv
 import pandas as pd
 import sqlite3
 import json
 import time
 
+# orjson is an optional, much faster drop-in for json.loads; both accept bytes and
+# orjson.JSONDecodeError subclasses json.JSONDecodeError
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 # Assuming this utility file is in the 'app' directory
 current_script_dir = os.path.dirname(os.path.abspath(__file__))
 # Project root is the directory above 'app'
@@ -28,14 +36,13 @@ def load_queries_txt(filepath):
     start_time = time.time()
     queries = {}
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().split('\t', 1)
-                if len(parts) == 2:
-                    qid, query_text = parts
-                    queries[qid] = query_text
-                # else:
-                #     print(f"Warning: Skipping malformed query line in {filepath}: {line.strip()}")
+        # C tokenizer; quoting is disabled so quotes inside query text are kept verbatim
+        df = pd.read_csv(filepath, sep='\t', header=None, usecols=[0, 1], names=['qid', 'text'], dtype=str,
+                         quoting=csv.QUOTE_NONE, keep_default_na=False, on_bad_lines='skip', engine='c', encoding='utf-8')
+        df['qid'] = df['qid'].str.strip()
+        df['text'] = df['text'].str.strip()
+        df = df[(df['qid'] != '') & (df['text'] != '')]
+        queries = dict(zip(df['qid'].tolist(), df['text'].tolist()))
     except FileNotFoundError:
         print(f"Error: Query file not found at {filepath}")
     except Exception as e:
@@ -48,16 +55,17 @@ def load_queries_jsonl(filepath):
     start_time = time.time()
     queries = {}
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line.strip())
-                    if '_id' in data and 'text' in data:
-                        queries[str(data['_id'])] = data['text']
-                    # else:
-                    #     print(f"Warning: Skipping malformed JSONL line (missing '_id' or 'text') in {filepath}: {line.strip()}")
-                except json.JSONDecodeError:
-                    pass # print(f"Warning: Skipping invalid JSONL line in {filepath}: {line.strip()}")
+        with open(filepath, 'rb') as f:
+            lines = f.read().split(b'\n')
+        for line in lines:
+            try:
+                data = _json_loads(line)
+                if '_id' in data and 'text' in data:
+                    queries[str(data['_id'])] = data['text']
+                # else:
+                #     print(f"Warning: Skipping malformed JSONL line (missing '_id' or 'text') in {filepath}: {line.strip()}")
+            except json.JSONDecodeError:
+                pass # print(f"Warning: Skipping invalid JSONL line in {filepath}: {line.strip()}")
     except FileNotFoundError:
         print(f"Error: Query file not found at {filepath}")
     except Exception as e:
@@ -74,34 +82,22 @@ def load_qrels(filepath, delimiter=' ', skip_header=False):
     start_time = time.time()
     qrels = {}
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            if skip_header:
-                next(f) # Skip the header line
-            for line in f:
-                parts = line.strip().split(delimiter)
-                
-                qid = None
-                doc_id = None
-                relevance = None
-
-                if delimiter == '\t': # Webis format: qid \t docid \t relevance
-                    if len(parts) >= 3:
-                        qid = parts[0]
-                        doc_id = parts[1]
-                        relevance = parts[2]
-                elif delimiter == ' ':
-                    if len(parts) >= 4: # Antique format: qid Q0 docid relevance
-                        qid = parts[0]
-                        doc_id = parts[2] # docid is the 3rd field (index 2)
-                        relevance = parts[3] # relevance is the 4th field (index 3)
-                
-                if qid is not None and doc_id is not None and relevance is not None:
-                    try:
-                        qrels.setdefault(qid, {})[doc_id] = int(relevance)
-                    except ValueError:
-                        pass # print(f"Warning: Skipping qrels line with non-integer relevance in {filepath}: {line.strip()}")
-                # else:
-                #     print(f"Warning: Skipping malformed qrels line (could not parse fields) in {filepath}: {line.strip()}")
+        if delimiter == '\t': # Webis format: qid \t docid \t relevance
+            columns = [0, 1, 2]
+        elif delimiter == ' ': # Antique format: qid Q0 docid relevance
+            columns = [0, 2, 3]
+        else:
+            raise ValueError(f"Unsupported qrels delimiter: {delimiter!r}")
+
+        df = pd.read_csv(filepath, sep=delimiter, header=None, skiprows=1 if skip_header else 0, usecols=columns,
+                         dtype=str, quoting=csv.QUOTE_NONE, keep_default_na=False, on_bad_lines='skip', engine='c', encoding='utf-8')
+        df.columns = ['qid', 'doc_id', 'rel']
+        # Like int() before: rows whose relevance is not an integer literal ('2.7', '2.0', 'x') are skipped
+        df['rel'] = df['rel'].str.strip()
+        df = df[df['rel'].str.fullmatch(r'[+-]?\d+')]
+        df['rel'] = df['rel'].astype('int64')
+
+        qrels = {qid: dict(zip(group['doc_id'].tolist(), group['rel'].tolist())) for qid, group in df.groupby('qid', sort=False)}
     except FileNotFoundError:
         print(f"Error: Qrels file not found at {filepath}")
     except Exception as e:
@@ -129,10 +125,11 @@ def load_all_doc_ids_from_db(dataset_name):
         conn = sqlite3.connect(DB_PATH)
         table_name = f'cleaned_{dataset_name}'
         id_column = 'id' if dataset_name == 'antique' else '_id'
-        query = f"SELECT {id_column} FROM {table_name}"
-        df = pd.read_sql_query(query, conn)
+        # Insertion order, which TF-IDF matrix rows follow (an id index would otherwise return ids sorted)
+        query = f"SELECT {id_column} FROM {table_name} ORDER BY rowid"
+        doc_ids = [row[0] for row in conn.execute(query)]
         print(f"Time to load all doc IDs for {dataset_name} from DB: {time.time() - start_time:.4f} seconds")
-        return df[id_column].tolist()
+        return doc_ids
     except Exception as e:
         print(f"Error loading document IDs from DB table '{table_name}': {e}")
         return []
@@ -1,10 +1,15 @@
+import logging
 import os
 import sqlite3
-import pandas as pd
+import threading
+import functools
+import json
 import traceback
 import time
 from typing import Optional, List, Dict
 
+logger = logging.getLogger(__name__)
+
 # --- Path Setup ---
 current_script_dir = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.abspath(os.path.join(current_script_dir, '..'))
@@ -19,16 +24,88 @@ WEBIS_QRELS_PATH = os.path.join(DATA_BASE_DIR, 'webis-touche2020', 'qrels', 'tes
 
 DB_PATH = None
 
+DATASETS = ("antique", "webis")
+
+# --- Connection Pool (one persistent connection per thread) ---
+_conn_pool = {}
+_conn_pool_lock = threading.Lock()
+
+# journal_mode is stored in the database file, so it is set once from the bootstrap connection.
+# WAL lets concurrent readers proceed without blocking each other or a writer.
+_DATABASE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+)
+# The rest are per-connection: 1 GiB memory-mapped reads and a 128 MiB page cache
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-131072",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=1073741824",
+)
+# sqlite3 keeps compiled statements per connection, keyed by the exact SQL text.
+_STATEMENT_CACHE_SIZE = 256
+# Rows pulled per fetchmany() call on full-table scans
+_FETCH_BATCH_SIZE = 1000
+
+def _get_conn() -> sqlite3.Connection:
+    """Returns the calling thread's pooled connection, opening it on first use."""
+    if DB_PATH is None:
+        raise RuntimeError("Document service not initialized. Call initialize_document_data first.")
+
+    thread_id = threading.get_ident()
+    conn = _conn_pool.get(thread_id)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=_STATEMENT_CACHE_SIZE)
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        with _conn_pool_lock:
+            _conn_pool[thread_id] = conn
+    return conn
+
+def close_connections():
+    """Closes every pooled connection. Safe to call more than once."""
+    with _conn_pool_lock:
+        for conn in _conn_pool.values():
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"WARNING (document_service): Failed to close pooled connection: {e}")
+        _conn_pool.clear()
+    _get_cached_query.cache_clear()
+
+# --- Cached SQL text (identical text lets sqlite3 reuse the compiled statement) ---
+@functools.lru_cache(maxsize=8)
+def _get_cached_query(dataset_name: str, kind: str) -> str:
+    """Returns the SQL for a lookup kind: "single", "batch" or "snippet_batch"."""
+    table_name = f'cleaned_{dataset_name}'
+    id_column = 'id' if dataset_name == 'antique' else '_id'
+    if kind == "single":
+        return f"SELECT text FROM {table_name} WHERE {id_column} = ?"
+    # The id list is bound as one JSON array, so the SQL text is the same for any batch size
+    if kind == "snippet_batch":
+        return f"SELECT {id_column}, substr(text, 1, ?) FROM {table_name} WHERE {id_column} IN (SELECT value FROM json_each(?))"
+    return f"SELECT {id_column}, text FROM {table_name} WHERE {id_column} IN (SELECT value FROM json_each(?))"
+
+def _ensure_id_indexes(conn: sqlite3.Connection):
+    """Creates the id lookup index on every known dataset table that exists."""
+    for dataset_name in DATASETS:
+        table_name = f'cleaned_{dataset_name}'
+        id_column = 'id' if dataset_name == 'antique' else '_id'
+        try:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone()
+            if exists:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_id ON {table_name}({id_column})")
+        except Exception as e:
+            print(f"WARNING (document_service): Could not create id index on '{table_name}': {e}")
+
 def _load_data_from_db(db_path, table_name, id_column_name):
     conn = None
     try:
         conn = sqlite3.connect(db_path)
         query = f"SELECT {id_column_name}, text FROM {table_name}"
         start_time_sql = time.time()
-        df = pd.read_sql_query(query, conn)
+        data_dict = dict(conn.execute(query).fetchall())
         # print(f"DEBUG (document_service): SQL query for {table_name} took: {time.time() - start_time_sql:.4f} seconds")
-        df.rename(columns={id_column_name: 'id', 'text': 'text'}, inplace=True)
-        data_dict = pd.Series(df.text.values, index=df.id).to_dict()
         # print(f"DEBUG (document_service): ✅ Data loaded from DB table '{table_name}'")
         return data_dict
     except Exception as e:
@@ -41,7 +118,16 @@ def _load_data_from_db(db_path, table_name, id_column_name):
 
 def initialize_document_data(project_root_path):
     global DB_PATH
+    close_connections()
     DB_PATH = os.path.join(project_root_path, 'IR_project.db')
+    if os.path.exists(DB_PATH):
+        conn = _get_conn()
+        for pragma in _DATABASE_PRAGMAS:
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error as e:
+                print(f"WARNING (document_service): '{pragma}' failed: {e}")
+        _ensure_id_indexes(conn)
     # print(f"DEBUG (document_service): Initializing document data. DB_PATH resolved to: {DB_PATH}")
     # print("DEBUG (document_service): Document texts will be loaded on-demand.")
 
@@ -49,12 +135,10 @@ def get_document_content(doc_id: str, dataset_name: str) -> Optional[str]:
     if DB_PATH is None:
         raise RuntimeError("Document service not initialized. Call initialize_document_data first.")
 
-    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _get_conn()
         table_name = f'cleaned_{dataset_name}'
-        id_column = 'id' if dataset_name == 'antique' else '_id'
-        query = f"SELECT text FROM {table_name} WHERE {id_column} = ?"
+        query = _get_cached_query(dataset_name, "single")
         
         cursor = conn.execute(query, (doc_id,))
         result = cursor.fetchone()
@@ -66,12 +150,9 @@ def get_document_content(doc_id: str, dataset_name: str) -> Optional[str]:
         print(f"Error loading document content for {doc_id} from DB table '{table_name}': {e}")
         traceback.print_exc()
         return None
-    finally:
-        if conn:
-            conn.close()
 
 def get_document_contents_batch(dataset_name: str, doc_ids: List[str]) -> Dict[str, str]:
-    start_total_time = time.time()
+    start_total_time = time.perf_counter()
     if DB_PATH is None:
         raise RuntimeError("Document service not initialized. Call initialize_document_data first.")
 
@@ -79,45 +160,69 @@ def get_document_contents_batch(dataset_name: str, doc_ids: List[str]) -> Dict[s
     if not doc_ids:
         return documents_map
 
-    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _get_conn()
         table_name = f'cleaned_{dataset_name}'
-        id_column = 'id' if dataset_name == 'antique' else '_id'
         
-        placeholders = ','.join('?' for _ in doc_ids)
-        query = f"SELECT {id_column}, text FROM {table_name} WHERE {id_column} IN ({placeholders})"
+        query = _get_cached_query(dataset_name, "batch")
         
-        cursor = conn.execute(query, doc_ids)
+        cursor = conn.execute(query, (json.dumps(list(doc_ids)),))
         for row in cursor:
             documents_map[row[0]] = row[1]
         
         # print(f"DEBUG (document_service): Retrieved {len(documents_map)} documents for {dataset_name} out of {len(doc_ids)} requested.")
-        print(f"Time to retrieve {len(documents_map)} documents for {dataset_name} in batch: {time.time() - start_total_time:.4f} seconds")
+        logger.debug("Time to retrieve %s documents for %s in batch: %.4f seconds", len(documents_map), dataset_name, time.perf_counter() - start_total_time)
         return documents_map
     except Exception as e:
         print(f"Error loading document contents batch from DB table '{table_name}': {e}")
         traceback.print_exc()
         return {}
-    finally:
-        if conn:
-            conn.close()
+
+def get_document_snippets_batch(dataset_name: str, doc_ids: List[str], max_chars: int = 150) -> Dict[str, str]:
+    """Like get_document_contents_batch, but SQLite truncates the text so only the snippet reaches Python.
+    Snippets longer than max_chars are cut and end with "..."."""
+    start_total_time = time.perf_counter()
+    if DB_PATH is None:
+        raise RuntimeError("Document service not initialized. Call initialize_document_data first.")
+
+    snippets_map = {}
+    if not doc_ids:
+        return snippets_map
+
+    try:
+        conn = _get_conn()
+        table_name = f'cleaned_{dataset_name}'
+        
+        query = _get_cached_query(dataset_name, "snippet_batch")
+        
+        # One extra character tells us whether the text was longer than max_chars
+        cursor = conn.execute(query, (max_chars + 1, json.dumps(list(doc_ids))))
+        for doc_id, text in cursor:
+            text = text or ""
+            snippets_map[doc_id] = text[:max_chars] + "..." if len(text) > max_chars else text
+        
+        logger.debug("Time to retrieve %s snippets for %s in batch: %.4f seconds", len(snippets_map), dataset_name, time.perf_counter() - start_total_time)
+        return snippets_map
+    except Exception as e:
+        print(f"Error loading document snippets batch from DB table '{table_name}': {e}")
+        traceback.print_exc()
+        return {}
 
 def get_all_documents_for_faiss(dataset_name: str) -> Dict[str, str]:
     start_time = time.time()
-    conn = None
     documents_map = {}
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _get_conn()
         table_name = f'cleaned_{dataset_name}'
         id_column = 'id' if dataset_name == 'antique' else '_id'
         query = f"SELECT {id_column}, text FROM {table_name}"
         
         cursor = conn.cursor()
+        cursor.arraysize = _FETCH_BATCH_SIZE
         cursor.execute(query)
         
-        for row in cursor.fetchall():
-            documents_map[str(row[0])] = row[1]
+        while rows := cursor.fetchmany():
+            documents_map.update((str(doc_id), text) for doc_id, text in rows)
         
         print(f"Time to load all documents for FAISS build from '{table_name}': {time.time() - start_time:.4f} seconds. Count: {len(documents_map)}")
         return documents_map
@@ -125,31 +230,29 @@ def get_all_documents_for_faiss(dataset_name: str) -> Dict[str, str]:
         print(f"Error loading all documents for FAISS build from DB table '{table_name}': {e}")
         traceback.print_exc()
         return {}
-    finally:
-        if conn:
-            conn.close()
 
 def load_all_doc_ids_from_db(dataset_name: str) -> List[str]:
     start_time = time.time()
     if DB_PATH is None:
         raise RuntimeError("Document service not initialized. Call initialize_document_data first.")
 
-    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _get_conn()
         table_name = f'cleaned_{dataset_name}'
         id_column = 'id' if dataset_name == 'antique' else '_id'
-        query = f"SELECT {id_column} FROM {table_name}"
+        # The id index covers this scan and would return ids sorted; TF-IDF matrix rows follow insertion order
+        query = f"SELECT {id_column} FROM {table_name} ORDER BY rowid"
+        
+        cursor = conn.cursor()
+        cursor.arraysize = _FETCH_BATCH_SIZE
+        cursor.execute(query)
         
-        df = pd.read_sql_query(query, conn)
+        doc_ids = []
+        while rows := cursor.fetchmany():
+            doc_ids.extend(row[0] for row in rows)
         print(f"Time to load all doc IDs for {dataset_name} from DB: {time.time() - start_time:.4f} seconds")
-        return df[id_column].tolist()
+        return doc_ids
     except Exception as e:
         print(f"Error loading document IDs from DB table '{table_name}': {e}")
         traceback.print_exc()
         return []
-    finally:
-        if conn:
-            conn.close()
-
-
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+
+ONNX_MODELS_BASE_DIR = os.path.join(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')), 'ONNX_Models')
+ONNX_INT8_FILE_NAME = 'model_int8.onnx'
+ENCODER_MAX_SEQ_LENGTH = 256
+
+# Serializes first loads so two services starting together don't both load the same model
+_load_lock = threading.Lock()
+
+class OnnxSentenceEncoder:
+    """Int8-quantized MiniLM on ONNX Runtime with SentenceTransformer's mean pooling and L2 normalization."""
+
+    def __init__(self, model_dir: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, local_files_only=True)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=ONNX_INT8_FILE_NAME, provider="CPUExecutionProvider", local_files_only=True
+        )
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=ENCODER_MAX_SEQ_LENGTH, return_tensors="np")
+        token_embeddings = np.asarray(self.model(**inputs).last_hidden_state, dtype=np.float32)
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+def _export_int8_encoder(model_name: str, model_dir: str):
+    """Exports model_name to ONNX in model_dir and writes a dynamically int8-quantized copy next to it."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoTokenizer
+    start_time = time.time()
+    os.makedirs(model_dir, exist_ok=True)
+    ORTModelForFeatureExtraction.from_pretrained(model_name, export=True, local_files_only=True).save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(model_name, local_files_only=True).save_pretrained(model_dir)
+    # Weights only; activations are quantized per call, so no calibration data is needed
+    quantize_dynamic(os.path.join(model_dir, 'model.onnx'), os.path.join(model_dir, ONNX_INT8_FILE_NAME), weight_type=QuantType.QInt8)
+    print(f"Time to export int8 ONNX encoder for '{model_name}': {time.time() - start_time:.4f} seconds")
+
+@lru_cache(maxsize=4)
+def _load_onnx_encoder(model_name: str):
+    model_dir = os.path.join(ONNX_MODELS_BASE_DIR, model_name.replace('/', '__'))
+    if not os.path.exists(os.path.join(model_dir, ONNX_INT8_FILE_NAME)):
+        _export_int8_encoder(model_name, model_dir)
+    start_time = time.time()
+    encoder = OnnxSentenceEncoder(model_dir)
+    print(f"Time to load int8 ONNX encoder '{model_name}': {time.time() - start_time:.4f} seconds")
+    return encoder
+
+@lru_cache(maxsize=4)
+def _load_sentence_transformer(model_name: str):
+    from sentence_transformers import SentenceTransformer
+    start_time = time.time()
+    model = SentenceTransformer(model_name, local_files_only=True)
+    print(f"Time to load SentenceTransformer model '{model_name}': {time.time() - start_time:.4f} seconds")
+    return model
+
+def get_onnx_encoder(model_name: str) -> OnnxSentenceEncoder:
+    """Returns the process-wide int8 ONNX encoder for model_name, exporting and quantizing it on first use.
+    Raises if optimum/onnxruntime are not installed."""
+    with _load_lock:
+        return _load_onnx_encoder(model_name)
+
+def get_sentence_transformer(model_name: str):
+    """Returns the process-wide SentenceTransformer for model_name, loading it on first use."""
+    with _load_lock:
+        return _load_sentence_transformer(model_name)
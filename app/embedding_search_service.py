@@ -1,107 +1,317 @@
+import logging
 import os
 import sys
+import mmap
 import joblib
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import pyarrow as pa
+import pyarrow.parquet as pq
 import traceback
-import heapq
 import time
+import functools
+import threading
+
+# numba is optional: without it embedding_search uses the blocked numpy scan below
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None
 
 import app.query_processing_service as query_processing_service
 import app.document_service as document_service
+from app.file_utils import atomic_output_path
+
+logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = None
 
 EMBEDDING_OUTPUT_BASE_DIR = 'Embedding'
 
+# Result cache entries, keyed on (normalized query, dataset, top_n)
+SEARCH_RESULT_CACHE_SIZE = 10000
+
+# Rows de-quantized per step of the int8 scan (bounds the float32 scratch buffer)
+INT8_SCAN_BLOCK_ROWS = 65536
+
+# Serializes first loads, so concurrent requests don't rewrite files another thread has memory-mapped
+_load_lock = threading.Lock()
+
 global_loaded_data = {
     "antique": {
-        "embeddings": None, "doc_ids": None
+        "embeddings": None, "doc_ids": None, "id_to_idx": None, "embeddings_int8": None, "embedding_scales": None
     },
     "webis": {
-        "embeddings": None, "doc_ids": None
+        "embeddings": None, "doc_ids": None, "id_to_idx": None, "embeddings_int8": None, "embedding_scales": None
     }
 }
 
+def _advise_sequential(array):
+    """Asks the kernel for aggressive readahead on a memory-mapped array that is scanned front to back."""
+    mapped = getattr(array, '_mmap', None)
+    if mapped is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        try:
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def _quantize_embeddings_int8(embeddings):
+    """Symmetric per-row int8 quantization: embeddings ~= embeddings_int8 * scales[:, None]."""
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    embeddings_int8 = np.round(embeddings / scales[:, None]).astype(np.int8)
+    return embeddings_int8, scales.astype(np.float32)
+
+def _load_int8_embeddings(dataset_name, embeddings):
+    """Loads the int8 copy of the normalized embeddings, building and saving it on first use.
+    Called under _load_lock."""
+    dataset_dir = os.path.join(PROJECT_ROOT, EMBEDDING_OUTPUT_BASE_DIR, dataset_name)
+    int8_path = os.path.join(dataset_dir, f'{dataset_name}_embeddings_int8.npy')
+    scales_path = os.path.join(dataset_dir, f'{dataset_name}_embeddings_int8_scales.npy')
+
+    # Embeddings regenerated at the same N x d keep the shape, so staleness is judged by mtime against
+    # the sources; the scales file is written last and stands for the pair
+    source_paths = [os.path.join(dataset_dir, f'{dataset_name}_embeddings.npy'), os.path.join(dataset_dir, f'{dataset_name}_embeddings.joblib')]
+    is_current = os.path.exists(int8_path) and os.path.exists(scales_path) and all(
+        os.path.getmtime(path) <= os.path.getmtime(scales_path) for path in source_paths if os.path.exists(path)
+    )
+    if is_current:
+        embeddings_int8 = np.load(int8_path, mmap_mode='r')
+        scales = np.load(scales_path)
+        if embeddings_int8.shape == embeddings.shape:
+            _advise_sequential(embeddings_int8)
+            return embeddings_int8, scales
+    if os.path.exists(scales_path):
+        print(f"WARNING (embedding_search_service): Stale int8 embeddings for {dataset_name}, rebuilding.")
+
+    embeddings_int8, scales = _quantize_embeddings_int8(embeddings)
+    try:
+        # The scales file marks a complete pair: drop it first, so a crash before it is rewritten forces a rebuild
+        if os.path.exists(scales_path):
+            os.remove(scales_path)
+        with atomic_output_path(int8_path) as tmp_path:
+            np.save(tmp_path, embeddings_int8)
+        with atomic_output_path(scales_path) as tmp_path:
+            np.save(tmp_path, scales)
+        embeddings_int8 = np.load(int8_path, mmap_mode='r')
+        _advise_sequential(embeddings_int8)
+        return embeddings_int8, scales
+    except OSError as e:
+        print(f"WARNING (embedding_search_service): Could not save int8 embeddings for {dataset_name}: {e}")
+        return embeddings_int8, scales
+
+def _int8_similarities(embeddings_int8, scales, q):
+    """Inner products of the float32 query against the int8 rows, one block at a time."""
+    similarities = np.empty(embeddings_int8.shape[0], dtype=np.float32)
+    for start in range(0, embeddings_int8.shape[0], INT8_SCAN_BLOCK_ROWS):
+        end = start + INT8_SCAN_BLOCK_ROWS
+        similarities[start:end] = embeddings_int8[start:end].astype(np.float32) @ q
+    similarities *= scales
+    return similarities
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _fused_int8_topk(embeddings_int8, scales, q, k, n_chunks):
+        """One pass over the int8 rows: query normalization, dot product and a per-chunk
+        top-k min-heap. Returns n_chunks * k (score, row) candidates; empty slots have row -1."""
+        n, d = embeddings_int8.shape
+        q_norm = 0.0
+        for j in range(d):
+            q_norm += q[j] * q[j]
+        inv_q_norm = 1.0 / np.sqrt(q_norm) if q_norm > 0 else 1.0
+
+        chunk_size = (n + n_chunks - 1) // n_chunks
+        heap_scores = np.full((n_chunks, k), -np.inf, dtype=np.float32)
+        heap_rows = np.full((n_chunks, k), -1, dtype=np.int64)
+        for c in prange(n_chunks):
+            for i in range(c * chunk_size, min((c + 1) * chunk_size, n)):
+                acc = 0.0
+                for j in range(d):
+                    acc += embeddings_int8[i, j] * q[j]
+                score = acc * scales[i] * inv_q_norm
+                if score <= heap_scores[c, 0]:
+                    continue
+                # Replace the heap minimum and sift it down
+                heap_scores[c, 0] = score
+                heap_rows[c, 0] = i
+                pos = 0
+                while True:
+                    child = 2 * pos + 1
+                    if child >= k:
+                        break
+                    if child + 1 < k and heap_scores[c, child + 1] < heap_scores[c, child]:
+                        child += 1
+                    if heap_scores[c, child] >= heap_scores[c, pos]:
+                        break
+                    heap_scores[c, pos], heap_scores[c, child] = heap_scores[c, child], heap_scores[c, pos]
+                    heap_rows[c, pos], heap_rows[c, child] = heap_rows[c, child], heap_rows[c, pos]
+                    pos = child
+        return heap_scores.ravel(), heap_rows.ravel()
+else:
+    _fused_int8_topk = None
+
+def _fused_top_n(embeddings_int8, scales, query_embedding, top_n):
+    """Runs the fused kernel and merges its per-chunk candidates into the sorted top-N."""
+    n_chunks = max(1, min(embeddings_int8.shape[0], get_num_threads() * 4))
+    scores, rows = _fused_int8_topk(np.asarray(embeddings_int8), scales, np.ascontiguousarray(query_embedding, dtype=np.float32), top_n, n_chunks)
+    valid = rows >= 0
+    scores, rows = scores[valid], rows[valid]
+    order = np.argsort(-scores)[:top_n]
+    return rows[order], scores[order]
+
+def _normalized_embeddings_from_joblib(joblib_path):
+    embeddings = np.ascontiguousarray(joblib.load(joblib_path), dtype=np.float32)
+    # Corpus vectors are static: L2-normalize once so a query's cosine scores are a single matmul
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    embeddings /= norms
+    return embeddings
+
+def _load_normalized_embeddings(dataset_name):
+    """Memory-maps the normalized float32 embeddings, converting them from joblib to .npy on first use."""
+    dataset_dir = os.path.join(PROJECT_ROOT, EMBEDDING_OUTPUT_BASE_DIR, dataset_name)
+    joblib_path = os.path.join(dataset_dir, f'{dataset_name}_embeddings.joblib')
+    npy_path = os.path.join(dataset_dir, f'{dataset_name}_embeddings.npy')
+
+    needs_conversion = not os.path.exists(npy_path) or (
+        os.path.exists(joblib_path) and os.path.getmtime(joblib_path) > os.path.getmtime(npy_path)
+    )
+    if needs_conversion:
+        embeddings = _normalized_embeddings_from_joblib(joblib_path)
+        try:
+            with atomic_output_path(npy_path) as tmp_path:
+                np.save(tmp_path, embeddings)
+        except OSError as e:
+            print(f"WARNING (embedding_search_service): Could not save {npy_path}, keeping embeddings in RAM: {e}")
+            return embeddings
+    return np.load(npy_path, mmap_mode='r')
+
+def _load_doc_ids(dataset_name):
+    """Reads the row -> doc_id column from a memory-mapped Parquet file, converting it from joblib on first use."""
+    dataset_dir = os.path.join(PROJECT_ROOT, EMBEDDING_OUTPUT_BASE_DIR, dataset_name)
+    joblib_path = os.path.join(dataset_dir, f'{dataset_name}_ids.joblib')
+    parquet_path = os.path.join(dataset_dir, f'{dataset_name}_ids.parquet')
+
+    needs_conversion = not os.path.exists(parquet_path) or (
+        os.path.exists(joblib_path) and os.path.getmtime(joblib_path) > os.path.getmtime(parquet_path)
+    )
+    if needs_conversion:
+        doc_ids = pa.array([str(doc_id) for doc_id in joblib.load(joblib_path)], type=pa.large_string())
+        try:
+            with atomic_output_path(parquet_path) as tmp_path:
+                pq.write_table(pa.table({"doc_id": doc_ids}), tmp_path)
+        except OSError as e:
+            print(f"WARNING (embedding_search_service): Could not save {parquet_path}: {e}")
+            return doc_ids
+    return pq.read_table(parquet_path, memory_map=True).column("doc_id").combine_chunks()
+
 def _load_embedding_data_internal(dataset_name):
     start_time = time.time()
-    embeddings_path = os.path.join(PROJECT_ROOT, EMBEDDING_OUTPUT_BASE_DIR, dataset_name, f'{dataset_name}_embeddings.joblib')
-    ids_path = os.path.join(PROJECT_ROOT, EMBEDDING_OUTPUT_BASE_DIR, dataset_name, f'{dataset_name}_ids.joblib')
-    
-    embeddings = joblib.load(embeddings_path)
-    doc_ids = joblib.load(ids_path)
+    embeddings = _load_normalized_embeddings(dataset_name)
+    doc_ids = _load_doc_ids(dataset_name)
+
+    # Built once per load: pyarrow.compute.index_in would re-hash every doc_id on each query
+    id_to_idx = {doc_id: i for i, doc_id in enumerate(doc_ids.to_pylist())}
+
+    embeddings_int8, scales = _load_int8_embeddings(dataset_name, embeddings)
     print(f"Time to load embedding data for {dataset_name}: {time.time() - start_time:.4f} seconds")
-    return embeddings, doc_ids
+    return embeddings, doc_ids, id_to_idx, embeddings_int8, scales
 
 def initialize_embedding_models(project_root_path):
     global PROJECT_ROOT
     PROJECT_ROOT = project_root_path
 
-def embedding_search(query_text, dataset_name, top_n=10):
-    start_total_time = time.time()
-
+def ensure_loaded(dataset_name):
+    """Loads the embedding files for a dataset if they are not in memory yet and returns its entry in global_loaded_data."""
     dataset_data = global_loaded_data.get(dataset_name)
     
     if not dataset_data or dataset_data["embeddings"] is None:
-        try:
-            embeddings, doc_ids = _load_embedding_data_internal(dataset_name)
-            global_loaded_data[dataset_name]["embeddings"] = embeddings
-            global_loaded_data[dataset_name]["doc_ids"] = doc_ids
-        except Exception as e:
-            print(f"ERROR (embedding_search_service): Failed to load embedding data for {dataset_name.upper()} on demand: {e}")
-            traceback.print_exc()
-            raise RuntimeError(f"Embedding data for {dataset_name} could not be loaded.")
+        with _load_lock:
+            dataset_data = global_loaded_data.get(dataset_name)
+            # Another thread may have finished the load while this one waited
+            if not dataset_data or dataset_data["embeddings"] is None:
+                try:
+                    embeddings, doc_ids, id_to_idx, embeddings_int8, scales = _load_embedding_data_internal(dataset_name)
+                    global_loaded_data[dataset_name]["embedding_scales"] = scales
+                    global_loaded_data[dataset_name]["embeddings_int8"] = embeddings_int8
+                    global_loaded_data[dataset_name]["id_to_idx"] = id_to_idx
+                    global_loaded_data[dataset_name]["doc_ids"] = doc_ids
+                    # Set last: it is the field the unlocked check above reads
+                    global_loaded_data[dataset_name]["embeddings"] = embeddings
+                except Exception as e:
+                    print(f"ERROR (embedding_search_service): Failed to load embedding data for {dataset_name.upper()} on demand: {e}")
+                    traceback.print_exc()
+                    raise RuntimeError(f"Embedding data for {dataset_name} could not be loaded.")
         dataset_data = global_loaded_data.get(dataset_name)
 
     if not dataset_data or dataset_data["embeddings"] is None:
         raise RuntimeError(f"Embedding data for {dataset_name} not initialized. Check service startup logs.")
+    return dataset_data
 
-    embeddings = dataset_data["embeddings"]
+def embedding_search(query_text, dataset_name, top_n=10):
+    """Cached per (normalized query, dataset, top_n); each caller gets its own copies of the result dicts."""
+    cached_results = _cached_embedding_search(query_text.strip().lower(), dataset_name, top_n)
+    return [dict(result) for result in cached_results]
+
+@functools.lru_cache(maxsize=SEARCH_RESULT_CACHE_SIZE)
+def _cached_embedding_search(query_text, dataset_name, top_n):
+    return tuple(_embedding_search_uncached(query_text, dataset_name, top_n))
+
+def _embedding_search_uncached(query_text, dataset_name, top_n):
+    start_total_time = time.perf_counter()
+
+    dataset_data = ensure_loaded(dataset_name)
+
+    embeddings_int8 = dataset_data["embeddings_int8"]
+    embedding_scales = dataset_data["embedding_scales"]
     doc_ids = dataset_data["doc_ids"]
 
-    start_time_query_proc = time.time()
-    processed_query_info = query_processing_service.process_query(query_text)
-    query_embedding = np.array(processed_query_info["query_embedding"][0])
-    print(f"Time for query processing (embedding search): {time.time() - start_time_query_proc:.4f} seconds")
+    start_time_query_proc = time.perf_counter()
+    query_embedding = query_processing_service.encode_query(query_text)[0]
+    logger.debug("Time for query processing (embedding search): %.4f seconds", time.perf_counter() - start_time_query_proc)
 
-    start_time_cosine_sim = time.time()
-    similarities = cosine_similarity(query_embedding.reshape(1, -1), embeddings).flatten()
-    print(f"Time for cosine similarity calculation (embedding search): {time.time() - start_time_cosine_sim:.4f} seconds")
+    start_time_cosine_sim = time.perf_counter()
+    top_n = min(top_n, embeddings_int8.shape[0])
+    if top_n <= 0:
+        top_indices, top_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    elif _fused_int8_topk is not None:
+        top_indices, top_scores = _fused_top_n(embeddings_int8, embedding_scales, query_embedding, top_n)
+    else:
+        # encode_query already normalizes; only rescale (out of place) if it did not
+        q = query_embedding
+        q_norm = np.linalg.norm(q)
+        if q_norm > 0 and not np.isclose(q_norm, 1.0):
+            q = q / q_norm
+        similarities = _int8_similarities(embeddings_int8, embedding_scales, q)
+        top_indices = np.argpartition(-similarities, top_n - 1)[:top_n]
+        top_indices = top_indices[np.argsort(-similarities[top_indices])]
+        top_scores = similarities[top_indices]
+    top_n_scored_docs = list(zip(doc_ids.take(top_indices).to_pylist(), top_scores))
+    logger.debug("Time for similarity and top-N selection (embedding search): %.4f seconds", time.perf_counter() - start_time_cosine_sim)
     
-    results_with_scores = []
-    for i, score in enumerate(similarities):
-        results_with_scores.append((doc_ids[i], score))
-    
-    start_time_heapq = time.time()
-    top_n_scored_docs = heapq.nlargest(top_n, results_with_scores, key=lambda x: x[1])
-    print(f"Time for top-N selection (embedding search): {time.time() - start_time_heapq:.4f} seconds")
-    
-    start_time_snippets = time.time()
+    start_time_snippets = time.perf_counter()
     doc_ids_for_snippets = [doc_id for doc_id, score in top_n_scored_docs]
     
     snippets_map = {}
     if doc_ids_for_snippets:
         try:
-            snippets_map = document_service.get_document_contents_batch(dataset_name, doc_ids_for_snippets)
+            snippets_map = document_service.get_document_snippets_batch(dataset_name, doc_ids_for_snippets)
         except Exception as e:
             print(f"WARNING: Could not fetch snippets from document service in batch: {e}")
             traceback.print_exc()
-    print(f"Time for batch snippet retrieval (embedding search): {time.time() - start_time_snippets:.4f} seconds")
-
-    final_results = []
-    for doc_id, score in top_n_scored_docs:
-        doc_content = snippets_map.get(doc_id, "")
-        snippet = doc_content[:150] + "..." if len(doc_content) > 150 else doc_content
-        
-        final_results.append({
-            "doc_id": doc_id,
-            "score": float(score),
-            "snippet": snippet
-        })
+    logger.debug("Time for batch snippet retrieval (embedding search): %.4f seconds", time.perf_counter() - start_time_snippets)
+
+    final_results = [
+        {"doc_id": doc_id, "score": float(score), "snippet": snippets_map.get(doc_id, "")}
+        for doc_id, score in top_n_scored_docs
+    ]
     
-    end_total_time = time.time()
-    print(f"Total Embedding search execution time: {end_total_time - start_total_time:.4f} seconds")
+    end_total_time = time.perf_counter()
+    logger.debug("Total Embedding search execution time: %.4f seconds", end_total_time - start_total_time)
 
     return final_results
 
-
+if __name__ == '__main__':
+    # One-time migration: python -m app.embedding_search_service antique webis
+    initialize_embedding_models(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+    for name in sys.argv[1:] or list(global_loaded_data):
+        ensure_loaded(name)
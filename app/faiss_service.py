@@ -1,61 +1,252 @@
+import logging
 import os
 import sys
 import numpy as np
 import faiss
 import pickle
+import threading
 import time
 import traceback
+from collections import defaultdict
 from typing import List, Dict
 
 import app.text_processing_service as text_processing_service
 import app.document_service as document_service
+from app.embedding_model_cache import get_onnx_encoder, get_sentence_transformer
+from app.file_utils import atomic_output_path
+
+logger = logging.getLogger(__name__)
 
 loaded_faiss_data = {
     "indices": {},
     "metadata": {},
-    "sentence_transformer": None
+    "doc_to_chunks": {},
+    "gpu_indices": {},
+    "gpu_resources": None,
+    "sentence_transformer": None,
+    "encoder": None,
+    "encode_batcher": None
 }
 
 FAISS_OUTPUT_BASE_DIR = os.path.join(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')), 'FAISS_Indices')
 
+SENTENCE_TRANSFORMER_MODEL_NAME = 'all-MiniLM-L6-v2'
+ONNX_ENCODER_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+
+FAISS_DATASETS = ("antique", "webis")
+# Below this many vectors a flat scan is already fast and exact
+FLAT_INDEX_MAX_VECTORS = 10_000
+IVFPQ_NLIST = 4096
+IVFPQ_M = 32
+IVFPQ_NBITS = 8
+IVFPQ_NPROBE = 32
+# PQ scores are approximate: fetch this many times top_k from IVF-PQ and re-score them against the flat vectors
+REFINE_K_FACTOR = 4
+# FAISS warns when k-means gets fewer than 39 training points per centroid
+IVF_MIN_POINTS_PER_CENTROID = 39
+
+# Serializes lazy loads, so concurrent first requests load once and never see a half-published entry
+_load_lock = threading.Lock()
+
+class _EncodeBatcher:
+    """Coalesces concurrent encode calls: requests that queue up while one batch is
+    encoding are all served by the next single encoder call."""
+
+    def __init__(self, encoder):
+        self._encoder = encoder
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+
+    def encode(self, text: str) -> np.ndarray:
+        slot = {"text": text, "done": False, "embedding": None, "error": None}
+        with self._pending_lock:
+            self._pending.append(slot)
+        with self._encode_lock:
+            if not slot["done"]:
+                with self._pending_lock:
+                    batch, self._pending = self._pending, []
+                try:
+                    embeddings = self._encoder.encode([s["text"] for s in batch])
+                    for s, embedding in zip(batch, embeddings):
+                        s["embedding"] = embedding
+                except Exception as e:
+                    for s in batch:
+                        s["error"] = e
+                finally:
+                    for s in batch:
+                        s["done"] = True
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["embedding"].reshape(1, -1)
+
 def _load_faiss_dependencies_if_needed():
-    if loaded_faiss_data["sentence_transformer"] is None:
-        start_time = time.time()
-        try:
-            from sentence_transformers import SentenceTransformer
-            model_name = 'all-MiniLM-L6-v2'
-            loaded_faiss_data["sentence_transformer"] = SentenceTransformer(model_name, local_files_only=True)
-            print(f"Time to load SentenceTransformer model for FAISS: {time.time() - start_time:.4f} seconds")
-        except Exception as e:
-            print(f"CRITICAL ERROR: Failed to lazy load SentenceTransformer for FAISS: {e}")
-            raise
+    if loaded_faiss_data["encoder"] is None:
+        with _load_lock:
+            # Another thread may have finished the load while this one waited
+            if loaded_faiss_data["encoder"] is not None:
+                return
+            try:
+                encoder = get_onnx_encoder(ONNX_ENCODER_MODEL_NAME)
+            except Exception as e:
+                # optimum/onnxruntime are optional; the PyTorch model is the unquantized original
+                print(f"WARNING (faiss_service): ONNX query encoder unavailable, falling back to SentenceTransformer: {e}")
+                try:
+                    # Same instance query_processing_service uses, so the model is only loaded once
+                    loaded_faiss_data["sentence_transformer"] = get_sentence_transformer(SENTENCE_TRANSFORMER_MODEL_NAME)
+                    encoder = loaded_faiss_data["sentence_transformer"]
+                except Exception as e:
+                    print(f"CRITICAL ERROR: Failed to lazy load SentenceTransformer for FAISS: {e}")
+                    raise
+            loaded_faiss_data["encode_batcher"] = _EncodeBatcher(encoder)
+            # Set last: it is the field the unlocked check above reads
+            loaded_faiss_data["encoder"] = encoder
+
+def _flat_index_path(dataset: str) -> str:
+    return os.path.join(FAISS_OUTPUT_BASE_DIR, f'{dataset}_faiss.index')
+
+def _compressed_index_path(dataset: str) -> str:
+    return os.path.join(FAISS_OUTPUT_BASE_DIR, f'{dataset}_faiss_ivfpq.index')
+
+def _compressed_index_is_current(dataset: str) -> bool:
+    """True when the IVF-PQ index exists and is not older than the flat index it was built from."""
+    compressed_index_path = _compressed_index_path(dataset)
+    flat_index_path = _flat_index_path(dataset)
+    if not os.path.exists(compressed_index_path):
+        return False
+    return not os.path.exists(flat_index_path) or os.path.getmtime(flat_index_path) <= os.path.getmtime(compressed_index_path)
+
+def build_compressed_index(dataset: str) -> bool:
+    """Rebuilds the flat index of a dataset as IVF-PQ. Returns False when the corpus is small enough to stay flat."""
+    start_time = time.time()
+    flat_index = faiss.read_index(_flat_index_path(dataset))
+    n, d = flat_index.ntotal, flat_index.d
+    if n < FLAT_INDEX_MAX_VECTORS:
+        return False
+
+    if isinstance(flat_index, faiss.IndexFlat):
+        # Zero-copy view of the stored vectors instead of a second corpus-sized array;
+        # flat_index owns the memory and stays alive until the build returns
+        vectors = faiss.rev_swig_ptr(flat_index.get_xb(), n * d).reshape(n, d)
+    else:
+        vectors = flat_index.reconstruct_n(0, n)
+    nlist = max(1, min(IVFPQ_NLIST, n // IVF_MIN_POINTS_PER_CENTROID))
+    m = max(divisor for divisor in range(1, IVFPQ_M + 1) if d % divisor == 0)
+    quantizer = faiss.IndexFlat(d, flat_index.metric_type)
+    index = faiss.IndexIVFPQ(quantizer, d, nlist, m, IVFPQ_NBITS, flat_index.metric_type)
+    index.train(vectors)
+    index.add(vectors)
+    with atomic_output_path(_compressed_index_path(dataset)) as tmp_path:
+        faiss.write_index(index, tmp_path)
+    print(f"Time to build IVF-PQ index for '{dataset}' ({n} vectors, nlist={nlist}, M={m}): {time.time() - start_time:.4f} seconds")
+    return True
+
+def _build_doc_to_chunks(metadata: List[Dict]) -> Dict[str, List[int]]:
+    """Maps each doc_id to the positions of its chunks in the index."""
+    doc_to_chunks = defaultdict(list)
+    for i, meta in enumerate(metadata):
+        doc_to_chunks[meta["doc_id"]].append(i)
+    # Plain dict so lookups of unknown doc_ids don't insert empty entries
+    return dict(doc_to_chunks)
+
+def _read_index_mmap(index_path: str):
+    """Reads an index with its vectors/codes memory-mapped, so pages load on demand and can be evicted.
+    IVF-PQ precomputed L2 residual tables (nlist * M * 256 floats) are never built."""
+    try:
+        return faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_SKIP_PRECOMPUTE_TABLE)
+    except RuntimeError as e:
+        # Older faiss builds can't mmap every index type
+        print(f"WARNING (faiss_service): Could not memory-map {index_path}, reading it into RAM: {e}")
+        return faiss.read_index(index_path, faiss.IO_FLAG_SKIP_PRECOMPUTE_TABLE)
+
+def _gpu_available() -> bool:
+    # CPU-only faiss builds have no GPU symbols at all
+    return hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+
+def _copy_index_to_gpu(dataset: str, index):
+    """Keeps a GPU copy of the index for full-corpus searches; the CPU index still serves reconstruct()."""
+    try:
+        if loaded_faiss_data["gpu_resources"] is None:
+            # Owns the GPU memory and streams; must outlive every GPU index made from it
+            loaded_faiss_data["gpu_resources"] = faiss.StandardGpuResources()
+        if isinstance(index, faiss.IndexRefine):
+            # Only the IVF-PQ scan has a GPU version; the exact re-rank stays on the memory-mapped flat index
+            gpu_index = faiss.IndexRefine(faiss.index_cpu_to_gpu(loaded_faiss_data["gpu_resources"], 0, index.base_index), index.refine_index)
+            gpu_index.k_factor = index.k_factor
+        else:
+            gpu_index = faiss.index_cpu_to_gpu(loaded_faiss_data["gpu_resources"], 0, index)
+        loaded_faiss_data["gpu_indices"][dataset] = gpu_index
+    except Exception as e:
+        print(f"WARNING (faiss_service): Could not move FAISS index for {dataset} to GPU, searching on CPU: {e}")
 
 def _load_index_if_needed(dataset: str):
-    if dataset not in loaded_faiss_data["indices"]:
+    if dataset in loaded_faiss_data["indices"]:
+        return
+    with _load_lock:
+        # Another thread may have finished the load while this one waited
+        if dataset in loaded_faiss_data["indices"]:
+            return
         start_time = time.time()
-        index_path = os.path.join(FAISS_OUTPUT_BASE_DIR, f'{dataset}_faiss.index')
+        index_path = _flat_index_path(dataset)
+        compressed_index_path = _compressed_index_path(dataset)
         metadata_path = os.path.join(FAISS_OUTPUT_BASE_DIR, f'{dataset}_metadata.pkl')
         
+        # A compressed index older than the flat one would pair old chunk ids with new metadata
+        if _compressed_index_is_current(dataset) and os.path.exists(metadata_path):
+            index_path = compressed_index_path
+
+        index = metadata = doc_to_chunks = None
         if os.path.exists(index_path) and os.path.exists(metadata_path):
             try:
-                loaded_faiss_data["indices"][dataset] = faiss.read_index(index_path)
+                index = _read_index_mmap(index_path)
+                ivf_index = faiss.try_extract_index_ivf(index)
+                if ivf_index is not None:
+                    ivf_index.nprobe = IVFPQ_NPROBE
+                    # reconstruct() on IVF indices needs the id -> list map
+                    ivf_index.make_direct_map()
+                    if index_path == compressed_index_path and os.path.exists(_flat_index_path(dataset)):
+                        # Re-score IVF-PQ candidates exactly, so scores stay comparable to similarity_threshold;
+                        # reconstruct() on the refine index also returns the exact flat vectors
+                        index = faiss.IndexRefine(index, _read_index_mmap(_flat_index_path(dataset)))
+                        index.k_factor = REFINE_K_FACTOR
                 with open(metadata_path, 'rb') as f:
-                    loaded_faiss_data["metadata"][dataset] = pickle.load(f)
+                    metadata = pickle.load(f)
+                doc_to_chunks = _build_doc_to_chunks(metadata)
+                if _gpu_available():
+                    _copy_index_to_gpu(dataset, index)
                 print(f"Time to load FAISS index and metadata for '{dataset}': {time.time() - start_time:.4f} seconds")
             except Exception as e:
                 print(f"ERROR: Failed to lazy load FAISS index for {dataset}: {e}")
-                loaded_faiss_data["indices"][dataset] = None
-                loaded_faiss_data["metadata"][dataset] = None
+                index = metadata = doc_to_chunks = None
         else:
             print(f"ERROR: FAISS index files not found for dataset {dataset}. Please build them first.")
-            loaded_faiss_data["indices"][dataset] = None
-            loaded_faiss_data["metadata"][dataset] = None
+
+        loaded_faiss_data["metadata"][dataset] = metadata
+        loaded_faiss_data["doc_to_chunks"][dataset] = doc_to_chunks
+        # Set last: its key is what the unlocked check above reads
+        loaded_faiss_data["indices"][dataset] = index
 
 def initialize_faiss_service(project_root_path):
+    """Only checks what is on disk: IVF-PQ training takes far longer than a server worker may spend starting up."""
     os.makedirs(FAISS_OUTPUT_BASE_DIR, exist_ok=True)
+    for dataset in FAISS_DATASETS:
+        if os.path.exists(_flat_index_path(dataset)) and not _compressed_index_is_current(dataset):
+            print(f"WARNING (faiss_service): No current IVF-PQ index for {dataset}, searching the flat index. "
+                  f"Build it with 'python -m app.faiss_service build {dataset}'.")
+
+def build_compressed_indices(datasets) -> None:
+    """Builds the IVF-PQ index of every dataset whose flat index exists and is newer than it."""
+    for dataset in datasets:
+        if not os.path.exists(_flat_index_path(dataset)) or _compressed_index_is_current(dataset):
+            continue
+        try:
+            build_compressed_index(dataset)
+        except Exception as e:
+            print(f"WARNING (faiss_service): Could not build IVF-PQ index for {dataset}, keeping the flat index: {e}")
+            traceback.print_exc()
 
 def search_faiss(query: str, dataset: str, top_k: int = 5, similarity_threshold: float = 0.7) -> List[Dict]:
-    start_total_time = time.time()
+    start_total_time = time.perf_counter()
     _load_faiss_dependencies_if_needed()
     _load_index_if_needed(dataset)
     
@@ -67,19 +258,20 @@ def search_faiss(query: str, dataset: str, top_k: int = 5, similarity_threshold:
         return []
 
     try:
-        start_time_clean = time.time()
+        start_time_clean = time.perf_counter()
         cleaned_query = text_processing_service.clean_text(query)
-        print(f"Time for query cleaning (FAISS search): {time.time() - start_time_clean:.4f} seconds")
+        logger.debug("Time for query cleaning (FAISS search): %.4f seconds", time.perf_counter() - start_time_clean)
         if not cleaned_query: return []
         
-        start_time_encode = time.time()
-        query_embedding = loaded_faiss_data["sentence_transformer"].encode([cleaned_query])
+        start_time_encode = time.perf_counter()
+        query_embedding = np.ascontiguousarray(loaded_faiss_data["encode_batcher"].encode(cleaned_query), dtype=np.float32)
         faiss.normalize_L2(query_embedding)
-        print(f"Time for query embedding (FAISS search): {time.time() - start_time_encode:.4f} seconds")
+        logger.debug("Time for query embedding (FAISS search): %.4f seconds", time.perf_counter() - start_time_encode)
         
-        start_time_search = time.time()
-        scores, indices = index.search(query_embedding, top_k)
-        print(f"Time for FAISS index search: {time.time() - start_time_search:.4f} seconds")
+        start_time_search = time.perf_counter()
+        search_index = loaded_faiss_data["gpu_indices"].get(dataset, index)
+        scores, indices = search_index.search(query_embedding, top_k)
+        logger.debug("Time for FAISS index search: %.4f seconds", time.perf_counter() - start_time_search)
         
         results = []
         for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
@@ -88,11 +280,15 @@ def search_faiss(query: str, dataset: str, top_k: int = 5, similarity_threshold:
                 chunk_metadata['score'] = float(score)
                 results.append(chunk_metadata)
         
-        print(f"Total FAISS search execution time: {time.time() - start_total_time:.4f} seconds")
+        logger.debug("Total FAISS search execution time: %.4f seconds", time.perf_counter() - start_total_time)
         return results
     except Exception as e:
         print(f"ERROR (faiss_service): Failed to search FAISS index: {e}")
         traceback.print_exc()
         return []
 
-
+if __name__ == '__main__':
+    # Offline IVF-PQ build: python -m app.faiss_service build [antique webis]
+    if sys.argv[1:2] != ['build']:
+        sys.exit("Usage: python -m app.faiss_service build [dataset ...]")
+    build_compressed_indices(sys.argv[2:] or list(FAISS_DATASETS))
@@ -0,0 +1,21 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_output_path(final_path: str):
+    """Yields a temporary path in final_path's directory and moves it over final_path once the block
+    succeeds. Readers never see a partial file, and existing memory maps keep the old inode."""
+    directory, file_name = os.path.split(final_path)
+    # Same suffix as the target, so writers that append one (np.save adds .npy) use the path as given
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=f'.{file_name}.', suffix=os.path.splitext(file_name)[1])
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, final_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
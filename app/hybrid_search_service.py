@@ -1,103 +1,143 @@
+import logging
 import os
 import sys
 import traceback
-import heapq
 import time
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import faiss
 
 import app.tfidf_search_service as tfidf_search_service
 import app.embedding_search_service as embedding_search_service
 import app.query_processing_service as query_processing_service
 import app.document_service as document_service
+import app.faiss_service as faiss_service
+
+logger = logging.getLogger(__name__)
+
+# Long-lived workers for the TF-IDF stage, so each worker thread also keeps its pooled DB connection
+_tfidf_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-tfidf")
+
+# Result cache entries, keyed on (normalized query, dataset, top_n, top_k_sparse)
+SEARCH_RESULT_CACHE_SIZE = 10000
+
+def hybrid_search(query_text, dataset_name, top_n=10, top_k_sparse=1000, return_chunks=False):
+    """Cached per (normalized query, dataset, top_n, top_k_sparse); each caller gets its own copies of the result dicts.
+    With return_chunks, returns (results, chunk_scores), where chunk_scores maps every FAISS chunk id of the
+    returned documents to its similarity with the same query embedding."""
+    normalized_query = query_text.strip().lower()
+    results = [dict(result) for result in _cached_hybrid_search(normalized_query, dataset_name, top_n, top_k_sparse)]
+    if not return_chunks:
+        return results
+
+    start_time_chunks = time.perf_counter()
+    chunk_scores = _score_result_chunks(normalized_query, dataset_name, [result["doc_id"] for result in results])
+    logger.debug("Time for chunk scoring (hybrid search): %.4f seconds. Scored %s chunks.", time.perf_counter() - start_time_chunks, len(chunk_scores))
+    return results, chunk_scores
+
+def _score_result_chunks(query_text, dataset_name, doc_ids):
+    """Scores every FAISS chunk of doc_ids against the query embedding. Returns {chunk id: score}."""
+    if not doc_ids:
+        return {}
+    faiss_service._load_index_if_needed(dataset_name)
+    full_index = faiss_service.loaded_faiss_data["indices"].get(dataset_name)
+    doc_to_chunks = faiss_service.loaded_faiss_data["doc_to_chunks"].get(dataset_name)
+    if full_index is None or not doc_to_chunks:
+        print(f"ERROR (hybrid_search_service): FAISS index for {dataset_name} not loaded.")
+        return {}
+
+    chunk_ids = np.fromiter(itertools.chain.from_iterable(doc_to_chunks.get(doc_id, ()) for doc_id in doc_ids), dtype=np.int64)
+    if not len(chunk_ids):
+        return {}
+    # The chunks of a few dozen documents: gathering their vectors and taking one product is
+    # cheaper than searching the full index under an ID filter. Vectors come from the flat index
+    # (directly, or as the refine layer over IVF-PQ), so the scores are exact; only an IVF-PQ
+    # index loaded without its flat file falls back to approximate PQ-decoded vectors
+    if isinstance(full_index, faiss.IndexRefine):
+        full_index = full_index.refine_index
+    chunk_vectors = np.empty((len(chunk_ids), full_index.d), dtype=np.float32)
+    full_index.reconstruct_batch(chunk_ids, chunk_vectors)
+    scores = chunk_vectors @ query_processing_service.encode_query(query_text)[0]
+    return dict(zip(chunk_ids.tolist(), scores.tolist()))
+
+@functools.lru_cache(maxsize=SEARCH_RESULT_CACHE_SIZE)
+def _cached_hybrid_search(query_text, dataset_name, top_n, top_k_sparse):
+    return tuple(_hybrid_search_uncached(query_text, dataset_name, top_n, top_k_sparse))
+
+def _hybrid_search_uncached(query_text, dataset_name, top_n, top_k_sparse):
+    start_total_time = time.perf_counter()
+
+    # TF-IDF retrieval and query embedding are independent: run TF-IDF in the background
+    start_time_tfidf = time.perf_counter()
+    tfidf_future = _tfidf_executor.submit(tfidf_search_service.tfidf_search, query_text, dataset_name, top_n=top_k_sparse)
+
+    start_time_query_embedding = time.perf_counter()
+    try:
+        query_embedding = query_processing_service.encode_query(query_text)[0]
+    except Exception as e:
+        print(f"ERROR (hybrid_search_service): Error getting query embedding: {e}")
+        traceback.print_exc()
+        raise
+    logger.debug("Time for query embedding (hybrid search): %.4f seconds", time.perf_counter() - start_time_query_embedding)
 
-def hybrid_search(query_text, dataset_name, top_n=10, top_k_sparse=1000):
-    start_total_time = time.time()
-
-    start_time_tfidf = time.time()
     try:
-        tfidf_results = tfidf_search_service.tfidf_search(query_text, dataset_name, top_n=top_k_sparse)
+        tfidf_results = tfidf_future.result()
     except Exception as e:
         print(f"ERROR (hybrid_search_service): Error during TF-IDF retrieval: {e}")
         traceback.print_exc()
         raise
-    print(f"Time for TF-IDF retrieval (hybrid search): {time.time() - start_time_tfidf:.4f} seconds. Found {len(tfidf_results)} candidates.")
+    logger.debug("Time for TF-IDF retrieval (hybrid search): %.4f seconds. Found %s candidates.", time.perf_counter() - start_time_tfidf, len(tfidf_results))
 
     if not tfidf_results:
         return []
     
     candidate_doc_ids = [result["doc_id"] for result in tfidf_results]
 
-    start_time_query_embedding = time.time()
-    try:
-        processed_query_info = query_processing_service.process_query(query_text)
-        query_embedding = np.array(processed_query_info["query_embedding"][0])
-    except Exception as e:
-        print(f"ERROR (hybrid_search_service): Error getting query embedding: {e}")
-        traceback.print_exc()
-        raise
-    print(f"Time for query embedding (hybrid search): {time.time() - start_time_query_embedding:.4f} seconds")
-
-    if embedding_search_service.global_loaded_data[dataset_name]["embeddings"] is None:
-        embedding_search_service.embedding_search("dummy query", dataset_name, top_n=1) 
-
-    dataset_embeddings = embedding_search_service.global_loaded_data[dataset_name]["embeddings"]
-    dataset_doc_ids = embedding_search_service.global_loaded_data[dataset_name]["doc_ids"]
+    embedding_data = embedding_search_service.ensure_loaded(dataset_name)
+    dataset_embeddings = embedding_data["embeddings"]
+    id_to_idx = embedding_data["id_to_idx"]
     
-    doc_id_to_embedding_idx = {doc_id: i for i, doc_id in enumerate(dataset_doc_ids)}
+    candidate_original_doc_ids = [doc_id for doc_id in candidate_doc_ids if doc_id in id_to_idx]
     
-    candidate_embeddings_list = []
-    candidate_original_doc_ids = []
-    
-    for doc_id in candidate_doc_ids:
-        idx = doc_id_to_embedding_idx.get(doc_id)
-        if idx is not None:
-            candidate_embeddings_list.append(dataset_embeddings[idx])
-            candidate_original_doc_ids.append(doc_id)
-    
-    if not candidate_embeddings_list:
+    if not candidate_original_doc_ids:
         return []
 
-    candidate_embeddings = np.array(candidate_embeddings_list)
+    candidate_idxs = np.fromiter((id_to_idx[doc_id] for doc_id in candidate_original_doc_ids), dtype=np.int64, count=len(candidate_original_doc_ids))
+    candidate_embeddings = dataset_embeddings[candidate_idxs]
 
-    start_time_reranking = time.time()
-    reranked_scores = cosine_similarity(query_embedding.reshape(1, -1), candidate_embeddings).flatten()
-    print(f"Time for re-ranking (hybrid search): {time.time() - start_time_reranking:.4f} seconds")
+    start_time_reranking = time.perf_counter()
+    # Both sides are L2-normalized, so cosine similarity is a plain matrix-vector product
+    reranked_scores = candidate_embeddings @ query_embedding
+    logger.debug("Time for re-ranking (hybrid search): %.4f seconds", time.perf_counter() - start_time_reranking)
 
-    # FIX: Define reranked_results_with_scores before using it
-    reranked_results_with_scores = []
-    for i, score in enumerate(reranked_scores):
-        reranked_results_with_scores.append((candidate_original_doc_ids[i], score))
+    start_time_sort_top_n = time.perf_counter()
+    top_n = min(top_n, len(reranked_scores))
+    top_indices = np.argpartition(-reranked_scores, top_n - 1)[:top_n] if top_n > 0 else np.empty(0, dtype=np.int64)
+    top_indices = top_indices[np.argsort(-reranked_scores[top_indices])]
+    final_top_n_scored_docs = [(candidate_original_doc_ids[i], reranked_scores[i]) for i in top_indices]
+    logger.debug("Time for final sort and top N (hybrid search): %.4f seconds", time.perf_counter() - start_time_sort_top_n)
 
-    start_time_sort_top_n = time.time()
-    final_top_n_scored_docs = heapq.nlargest(top_n, reranked_results_with_scores, key=lambda x: x[1])
-    print(f"Time for final sort and top N (hybrid search): {time.time() - start_time_sort_top_n:.4f} seconds")
-
-    start_time_snippets = time.time()
+    start_time_snippets = time.perf_counter()
     doc_ids_for_snippets = [doc_id for doc_id, score in final_top_n_scored_docs]
     
     snippets_map = {}
     if doc_ids_for_snippets:
         try:
-            snippets_map = document_service.get_document_contents_batch(dataset_name, doc_ids_for_snippets)
+            snippets_map = document_service.get_document_snippets_batch(dataset_name, doc_ids_for_snippets)
         except Exception as e:
             print(f"WARNING: Could not fetch snippets from document service in batch: {e}")
             traceback.print_exc()
-    print(f"Time for batch snippet retrieval (hybrid search): {time.time() - start_time_snippets:.4f} seconds")
-
-    final_results = []
-    for doc_id, score in final_top_n_scored_docs:
-        doc_content = snippets_map.get(doc_id, "")
-        snippet = doc_content[:150] + "..." if len(doc_content) > 150 else doc_content
-        
-        final_results.append({
-            "doc_id": doc_id,
-            "score": float(score),
-            "snippet": snippet
-        })
+    logger.debug("Time for batch snippet retrieval (hybrid search): %.4f seconds", time.perf_counter() - start_time_snippets)
+
+    final_results = [
+        {"doc_id": doc_id, "score": float(score), "snippet": snippets_map.get(doc_id, "")}
+        for doc_id, score in final_top_n_scored_docs
+    ]
     
-    end_total_time = time.time()
-    print(f"Total Hybrid search execution time: {end_total_time - start_total_time:.4f} seconds")
+    end_total_time = time.perf_counter()
+    logger.debug("Total Hybrid search execution time: %.4f seconds", end_total_time - start_total_time)
 
     return final_results
 
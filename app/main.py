@@ -1,10 +1,18 @@
+import logging
 import os
 import sys
 import traceback
 import time
-from flask import Flask, request, jsonify
+import json
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 
+# orjson is optional: a much faster serializer than Flask's json that also handles NumPy scalars
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- Path Setup ---
 current_script_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(current_script_dir, '..'))
@@ -13,7 +21,6 @@ if project_root not in sys.path:
 
 # --- Import all services ---
 import app.document_service as document_service
-import app.text_processing_service as text_processing_service
 import app.query_processing_service as query_processing_service
 import app.tfidf_search_service as tfidf_search_service
 import app.embedding_search_service as embedding_search_service
@@ -22,9 +29,23 @@ import app.faiss_service as faiss_service
 import app.rag_service as rag_service
 import app.pipeline_search_service as pipeline_search_service
 
+# Per-query stage timings are logged at DEBUG; run with LOG_LEVEL=DEBUG to see them
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper())
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+def _dumps(data) -> str:
+    if orjson is None:
+        return json.dumps(data)
+    return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+def _json_response(data):
+    if orjson is None:
+        return jsonify(data)
+    return Response(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY), mimetype="application/json")
+
 # --- Health Check Endpoint ---
 @app.route("/health")
 def health():
@@ -47,7 +68,7 @@ def unified_query_route():
         instruction_key = data.get("instruction_key", "default")
         result = {}
 
-        start_query_time = time.time()
+        start_query_time = time.perf_counter()
 
         # --- Dispatch to the correct service based on the method ---
         if method == "tfidf":
@@ -73,22 +94,66 @@ def unified_query_route():
         else:
             return jsonify({"error": f"Invalid method: {method}"}), 400
         
-        end_query_time = time.time()
+        end_query_time = time.perf_counter()
         total_query_duration = end_query_time - start_query_time
-        print(f"Total query execution time for method '{method}' on dataset '{dataset_name}': {total_query_duration:.4f} seconds")
+        logger.debug("Total query execution time for method '%s' on dataset '%s': %.4f seconds", method, dataset_name, total_query_duration)
 
         result['query'] = query_text
         result['dataset'] = dataset_name
         result['method'] = method
         result['total_query_duration'] = total_query_duration # Add duration to result
         
-        return jsonify(result)
+        return _json_response(result)
 
     except Exception as e:
         print(f"ERROR (main.py): Error in /unified_query route: {e}")
         traceback.print_exc()
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {_dumps(data)}\n\n"
+
+# --- Streaming RAG Endpoint ---
+@app.route("/unified_query_stream", methods=["POST", "OPTIONS"])
+def unified_query_stream_route():
+    """Server-sent events for the RAG methods: one 'context' event with the retrieved documents,
+    'token' events carrying the answer text as it is generated, then 'done'."""
+    if request.method == 'OPTIONS':
+        return '', 200
+    try:
+        data = request.get_json()
+        query_text = data.get("query")
+        dataset_name = data.get("dataset")
+        method = data.get("method")
+
+        if not all([query_text, dataset_name, method]):
+            return jsonify({"error": "Missing query, dataset, or method"}), 400
+
+        instruction_key = data.get("instruction_key", "default")
+        start_query_time = time.perf_counter()
+
+        if method == "rag_with_faiss":
+            retrieved_context, answer_pieces = rag_service.rag_query_stream(query_text, dataset_name, instruction_key=instruction_key)
+        elif method == "rag_with_basics":
+            retrieved_context, answer_pieces = pipeline_search_service.rag_with_basics_stream(query_text, dataset_name, instruction_key=instruction_key)
+        else:
+            return jsonify({"error": f"Streaming is only supported for RAG methods, got: {method}"}), 400
+
+        def generate_events():
+            yield _sse_event("context", {"query": query_text, "dataset": dataset_name, "method": method, "retrieved_context": retrieved_context})
+            for piece in answer_pieces:
+                if piece:
+                    yield _sse_event("token", piece)
+            yield _sse_event("done", {"total_query_duration": time.perf_counter() - start_query_time})
+
+        return Response(stream_with_context(generate_events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    except Exception as e:
+        print(f"ERROR (main.py): Error in /unified_query_stream route: {e}")
+        traceback.print_exc()
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
 # --- Get Document Endpoint ---
 @app.route("/get_document", methods=["POST", "OPTIONS"])
 def get_document_route():
@@ -103,7 +168,7 @@ def get_document_route():
         content = document_service.get_document_content(doc_id, dataset_name)
         if content is None:
             return jsonify({"error": "Document not found"}), 404
-        return jsonify({"doc_id": doc_id, "content": content})
+        return _json_response({"doc_id": doc_id, "content": content})
     except Exception as e:
         print(f"ERROR (main.py): Error in /get_document route: {e}")
         traceback.print_exc()
@@ -114,7 +179,7 @@ def initialize_all_services():
     start_time = time.time()
     try:
         document_service.initialize_document_data(project_root)
-        text_processing_service.initialize_text_processor()
+        # Also initializes the text processor
         query_processing_service.initialize_query_processor()
         tfidf_search_service.initialize_tfidf_models(project_root)
         embedding_search_service.initialize_embedding_models(project_root)
@@ -126,8 +191,16 @@ def initialize_all_services():
         traceback.print_exc()
         sys.exit(1)
 
+def create_app():
+    """App factory for a production WSGI server, e.g.
+    gunicorn -k gthread -w 1 --threads 8 -b 0.0.0.0:5000 "app.main:create_app()"
+    One process with threads keeps a single copy of the models; TF-IDF, NumPy and FAISS
+    release the GIL, so queries run concurrently with a long RAG generation."""
+    initialize_all_services()
+    return app
+
 if __name__ == '__main__':
     initialize_all_services()
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False, threaded=True)
 
 
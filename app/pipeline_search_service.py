@@ -1,6 +1,7 @@
+import logging
 import time
-import numpy as np
-import faiss
+import heapq
+import operator
 from typing import List, Dict
 
 import app.hybrid_search_service as hybrid_search_service
@@ -8,86 +9,55 @@ import app.faiss_service as faiss_service
 import app.document_service as document_service
 import app.rag_service as rag_service
 
+logger = logging.getLogger(__name__)
+
 def get_basic_pipeline_candidates(query_text: str, dataset_name: str, top_n: int = 10) -> List[Dict]:
-    start_time = time.time()
+    start_time = time.perf_counter()
     candidate_docs = hybrid_search_service.hybrid_search(query_text, dataset_name, top_n=top_n)
-    print(f"Time for basic pipeline (Hybrid Search) candidate retrieval: {time.time() - start_time:.4f} seconds")
+    logger.debug("Time for basic pipeline (Hybrid Search) candidate retrieval: %.4f seconds", time.perf_counter() - start_time)
     return candidate_docs
 
 def faiss_with_basics(query_text: str, dataset_name: str, top_k_chunks: int = 10) -> List[Dict]:
-    start_total_time = time.time()
+    start_total_time = time.perf_counter()
 
-    start_time_candidates = time.time()
-    candidate_docs = get_basic_pipeline_candidates(query_text, dataset_name, top_n=50)
-    print(f"Time to get candidate documents for faiss_with_basics: {time.time() - start_time_candidates:.4f} seconds")
-    if not candidate_docs:
+    start_time_candidates = time.perf_counter()
+    # One pass: the hybrid stage also scores the chunks of its candidate documents
+    candidate_docs, chunk_scores = hybrid_search_service.hybrid_search(query_text, dataset_name, top_n=50, return_chunks=True)
+    logger.debug("Time to get candidate documents and chunk scores for faiss_with_basics: %.4f seconds. Found %s chunks.", time.perf_counter() - start_time_candidates, len(chunk_scores))
+    if not chunk_scores:
         return []
-    
-    candidate_doc_ids = {doc["doc_id"] for doc in candidate_docs}
 
-    start_time_faiss_load = time.time()
-    faiss_service._load_index_if_needed(dataset_name)
-    faiss_service._load_faiss_dependencies_if_needed()
-    print(f"Time to load FAISS dependencies and index for faiss_with_basics: {time.time() - start_time_faiss_load:.4f} seconds")
-    
-    full_index = faiss_service.loaded_faiss_data["indices"].get(dataset_name)
     full_metadata = faiss_service.loaded_faiss_data["metadata"].get(dataset_name)
-
-    if not full_index or not full_metadata:
+    if not full_metadata:
         print(f"ERROR: FAISS index for {dataset_name} not loaded.")
         return []
 
-    start_time_filter_chunks = time.time()
-    candidate_chunk_indices = [i for i, meta in enumerate(full_metadata) if meta["doc_id"] in candidate_doc_ids]
-    print(f"Time to filter chunks for faiss_with_basics: {time.time() - start_time_filter_chunks:.4f} seconds. Found {len(candidate_chunk_indices)} chunks.")
-    
-    if not candidate_chunk_indices:
-        return []
-        
-    start_time_reconstruct = time.time()
-    candidate_vectors_np = np.array([full_index.reconstruct(int(i)) for i in candidate_chunk_indices]).astype("float32")
-    print(f"Time to reconstruct candidate vectors for faiss_with_basics: {time.time() - start_time_reconstruct:.4f} seconds")
+    start_time_top_k = time.perf_counter()
+    top_chunks = heapq.nlargest(top_k_chunks, chunk_scores.items(), key=operator.itemgetter(1))
+    final_results = [
+        {"doc_id": full_metadata[chunk_id]["doc_id"], "score": score, "snippet": full_metadata[chunk_id]["text"]}
+        for chunk_id, score in top_chunks
+    ]
+    logger.debug("Time for top-k chunk selection (faiss_with_basics): %.4f seconds", time.perf_counter() - start_time_top_k)
 
-    start_time_filtered_index = time.time()
-    filtered_index = faiss.IndexFlatIP(full_index.d)
-    filtered_index.add(candidate_vectors_np)
-    print(f"Time to build filtered FAISS index for faiss_with_basics: {time.time() - start_time_filtered_index:.4f} seconds")
-
-    start_time_query_embedding = time.time()
-    query_embedding = faiss_service.loaded_faiss_data["sentence_transformer"].encode([query_text])
-    faiss.normalize_L2(query_embedding)
-    print(f"Time for query embedding (faiss_with_basics): {time.time() - start_time_query_embedding:.4f} seconds")
-    
-    start_time_search = time.time()
-    scores, indices = filtered_index.search(query_embedding, top_k_chunks)
-    print(f"Time for FAISS search on filtered index (faiss_with_basics): {time.time() - start_time_search:.4f} seconds")
-
-    final_results = []
-    for i, score in zip(indices[0], scores[0]):
-        if i != -1:
-            original_metadata_index = candidate_chunk_indices[i]
-            chunk_metadata = full_metadata[original_metadata_index]
-            final_results.append({
-                "doc_id": chunk_metadata["doc_id"],
-                "score": float(score),
-                "snippet": chunk_metadata["text"]
-            })
-
-    print(f"Total faiss_with_basics Service execution time: {time.time() - start_total_time:.4f} seconds")
+    logger.debug("Total faiss_with_basics Service execution time: %.4f seconds", time.perf_counter() - start_total_time)
     return final_results
 
-def rag_with_basics(query_text: str, dataset_name: str, top_k_context: int = 3, instruction_key: str = "default") -> Dict:
-    start_total_time = time.time()
-    start_time_candidates = time.time()
+NO_CONTEXT_RESPONSE = "Could not find any relevant documents to generate an answer."
+
+def _prepare_rag_with_basics(query_text: str, dataset_name: str, top_k_context: int, instruction_key: str):
+    """Retrieves the context documents and builds the LLM prompt. Returns (retrieved_context, prompt);
+    prompt is None when no documents were found."""
+    start_time_candidates = time.perf_counter()
     context_docs = get_basic_pipeline_candidates(query_text, dataset_name, top_n=top_k_context)
-    print(f"Time to get candidate documents for rag_with_basics: {time.time() - start_time_candidates:.4f} seconds")
+    logger.debug("Time to get candidate documents for rag_with_basics: %.4f seconds", time.perf_counter() - start_time_candidates)
     if not context_docs:
-        return {"generated_response": "Could not find any relevant documents to generate an answer.", "retrieved_context": []}
+        return [], None
     
-    start_time_doc_content = time.time()
+    start_time_doc_content = time.perf_counter()
     context_doc_ids = [doc["doc_id"] for doc in context_docs]
     documents_map = document_service.get_document_contents_batch(dataset_name, context_doc_ids)
-    print(f"Time to retrieve full document contents for rag_with_basics: {time.time() - start_time_doc_content:.4f} seconds")
+    logger.debug("Time to retrieve full document contents for rag_with_basics: %.4f seconds", time.perf_counter() - start_time_doc_content)
     
     retrieved_context_for_prompt = [{
         "doc_id": doc["doc_id"],
@@ -95,11 +65,11 @@ def rag_with_basics(query_text: str, dataset_name: str, top_k_context: int = 3,
         "score": doc["score"]
     } for doc in context_docs]
     
-    start_time_rag_load = time.time()
+    start_time_rag_load = time.perf_counter()
     rag_service._load_rag_model_if_needed()
-    print(f"Time to load RAG model for rag_with_basics: {time.time() - start_time_rag_load:.4f} seconds")
+    logger.debug("Time to load RAG model for rag_with_basics: %.4f seconds", time.perf_counter() - start_time_rag_load)
     
-    start_time_format_prompt = time.time()
+    start_time_format_prompt = time.perf_counter()
     prompt = rag_service.format_context_for_llm(
         retrieved_context_for_prompt,
         query_text,
@@ -107,17 +77,29 @@ def rag_with_basics(query_text: str, dataset_name: str, top_k_context: int = 3,
         rag_service.rag_models["max_context_length"],
         instruction_key=instruction_key
     )
-    print(f"Time to format prompt for rag_with_basics: {time.time() - start_time_format_prompt:.4f} seconds")
+    logger.debug("Time to format prompt for rag_with_basics: %.4f seconds", time.perf_counter() - start_time_format_prompt)
+    return retrieved_context_for_prompt, prompt
+
+def rag_with_basics(query_text: str, dataset_name: str, top_k_context: int = 3, instruction_key: str = "default") -> Dict:
+    start_total_time = time.perf_counter()
+    retrieved_context_for_prompt, prompt = _prepare_rag_with_basics(query_text, dataset_name, top_k_context, instruction_key)
+    if prompt is None:
+        return {"generated_response": NO_CONTEXT_RESPONSE, "retrieved_context": []}
     
-    start_time_generate = time.time()
+    start_time_generate = time.perf_counter()
     generated_response = rag_service.generate_response(prompt)
-    print(f"Time to generate response for rag_with_basics: {time.time() - start_time_generate:.4f} seconds")
+    logger.debug("Time to generate response for rag_with_basics: %.4f seconds", time.perf_counter() - start_time_generate)
     
-    print(f"Total RAG_with_basics Service execution time: {time.time() - start_total_time:.4f} seconds")
+    logger.debug("Total RAG_with_basics Service execution time: %.4f seconds", time.perf_counter() - start_total_time)
     return {
         "query": query_text,
         "generated_response": generated_response,
         "retrieved_context": retrieved_context_for_prompt,
     }
 
-
+def rag_with_basics_stream(query_text: str, dataset_name: str, top_k_context: int = 3, instruction_key: str = "default"):
+    """Like rag_with_basics, but returns (retrieved_context, iterator over the answer text as it is generated)."""
+    retrieved_context_for_prompt, prompt = _prepare_rag_with_basics(query_text, dataset_name, top_k_context, instruction_key)
+    if prompt is None:
+        return [], iter([NO_CONTEXT_RESPONSE])
+    return retrieved_context_for_prompt, rag_service.stream_response(prompt)
@@ -1,21 +1,30 @@
-import time
 import json
-from sentence_transformers import SentenceTransformer
+import functools
+from app.embedding_model_cache import get_onnx_encoder, get_sentence_transformer
 import app.text_processing_service as text_processing_service
 
 # --- Use a dictionary for the loaded model cache ---
 _model_cache = {
+    "onnx_encoder": None,
     "sentence_transformer": None
 }
 SENTENCE_TRANSFORMER_MODEL_NAME = 'all-MiniLM-L6-v2'
+ONNX_ENCODER_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+
+# Recent query embeddings, so the stages of one request (and repeated queries) encode a query once
+QUERY_EMBEDDING_CACHE_SIZE = 1024
 
 def _load_model_if_needed():
-    """Checks if the SentenceTransformer is loaded and loads it if not."""
-    if _model_cache["sentence_transformer"] is None:
-        start_time = time.time()
+    """Loads the int8 ONNX query encoder, or the SentenceTransformer when ONNX Runtime is unavailable."""
+    if _model_cache["onnx_encoder"] is None and _model_cache["sentence_transformer"] is None:
+        try:
+            _model_cache["onnx_encoder"] = get_onnx_encoder(ONNX_ENCODER_MODEL_NAME)
+            return
+        except Exception as e:
+            # optimum/onnxruntime are optional; the PyTorch model is the unquantized original
+            print(f"WARNING (query_processing_service): ONNX query encoder unavailable, falling back to SentenceTransformer: {e}")
         try:
-            _model_cache["sentence_transformer"] = SentenceTransformer(SENTENCE_TRANSFORMER_MODEL_NAME, local_files_only=True)
-            print(f"Time to load SentenceTransformer model: {time.time() - start_time:.4f} seconds")
+            _model_cache["sentence_transformer"] = get_sentence_transformer(SENTENCE_TRANSFORMER_MODEL_NAME)
         except Exception as e:
             print(f"CRITICAL ERROR: Failed to lazy load SentenceTransformer model: {e}")
             raise
@@ -25,29 +34,18 @@ def initialize_query_processor():
     # print("DEBUG (query_processing_service): Query processor initialized (model will be lazy-loaded).")
     text_processing_service.initialize_text_processor()
 
-def process_query(raw_query_text):
-    """
-    Processes a raw query: cleans text and generates its embedding.
-    """
-    start_total_time = time.time()
-    _load_model_if_needed()
-    
-    if not raw_query_text:
-        return {"original_query": raw_query_text, "preprocessed_text": "", "query_embedding": []}
-
-    start_time_clean = time.time()
-    preprocessed_text = text_processing_service.clean_text(raw_query_text)
-    print(f"Time for query text cleaning: {time.time() - start_time_clean:.4f} seconds")
-    
-    start_time_embed = time.time()
-    query_embedding = _model_cache["sentence_transformer"].encode([raw_query_text], convert_to_tensor=True).cpu().numpy().tolist()
-    print(f"Time for query embedding generation: {time.time() - start_time_embed:.4f} seconds")
-
-    print(f"Total query processing time: {time.time() - start_total_time:.4f} seconds")
-    return {
-        "original_query": raw_query_text,
-        "preprocessed_text": preprocessed_text,
-        "query_embedding": query_embedding
-    }
-
+def encode_query(raw_query_text):
+    """L2-normalized float32 embedding of shape (1, dim) for a raw query. Cached and shared
+    between callers, so the returned array is read-only."""
+    # MiniLM's tokenizer lowercases, so case and surrounding whitespace don't change the embedding
+    return _cached_query_embedding(raw_query_text.strip().lower())
 
+@functools.lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+def _cached_query_embedding(query_text):
+    _load_model_if_needed()
+    if _model_cache["onnx_encoder"] is not None:
+        query_embedding = _model_cache["onnx_encoder"].encode([query_text])
+    else:
+        query_embedding = _model_cache["sentence_transformer"].encode([query_text], convert_to_numpy=True, normalize_embeddings=True)
+    query_embedding.setflags(write=False)
+    return query_embedding
@@ -1,9 +1,13 @@
+import logging
 import os
 import sys
 import traceback
 import time
 import json
-from typing import List, Dict, Optional
+import threading
+from functools import lru_cache
+from typing import List, Dict, Iterator, Optional
+import numpy as np
 import torch
 
 # --- Path Setup ---
@@ -14,6 +18,8 @@ if project_root not in sys.path:
 
 import app.faiss_service as faiss_service
 
+logger = logging.getLogger(__name__)
+
 # --- Use a dictionary for the loaded model cache ---
 rag_models = {
     "llm_model": None,
@@ -23,6 +29,11 @@ rag_models = {
     "max_response_length": 150,
 }
 
+# The shared LLM is not reentrant, so concurrent requests take turns generating
+_generate_lock = threading.Lock()
+# Serializes the first load, so concurrent first requests don't each load the model
+_load_lock = threading.Lock()
+
 SYSTEM_INSTRUCTIONS = {
     "default": "You are a helpful assistant. Based on the provided context, answer the question. If the context does not contain enough information, state that the documents did not contain the answer. Summarize the relevant points from the context to form your answer.",
     "comparative": "You are a highly analytical assistant. Your primary goal is to compare and contrast concepts from the provided context. Structure your answer to clearly highlight the similarities and differences.",
@@ -33,86 +44,133 @@ SYSTEM_INSTRUCTIONS = {
 def _load_rag_model_if_needed():
     """Checks if the LLM is loaded and loads it if not."""
     if rag_models["llm_model"] is None:
-        start_time = time.time()
-        try:
-            from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
-            
-            model_name = rag_models["model_name"]
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            # print(f"INFO (rag_service): Loading {model_name} on device: {device}")
-
-            rag_models["tokenizer"] = AutoTokenizer.from_pretrained(model_name, local_files_only=True)
-            rag_models["llm_model"] = AutoModelForSeq2SeqLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-                local_files_only=True
-            ).to(device)
-            rag_models["llm_model"].eval()
-            
-            print(f"Time to load RAG Language Model: {time.time() - start_time:.4f} seconds.")
-        except Exception as e:
-            print(f"CRITICAL ERROR: Failed to lazy load RAG Language Model: {e}")
-            raise
+        with _load_lock:
+            # Another thread may have finished the load while this one waited
+            if rag_models["llm_model"] is not None:
+                return
+            start_time = time.time()
+            try:
+                from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+                
+                model_name = rag_models["model_name"]
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+                # print(f"INFO (rag_service): Loading {model_name} on device: {device}")
+
+                if device == "cuda":
+                    # bf16 keeps fp32's exponent range, which T5 needs (its activations overflow in fp16)
+                    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+                else:
+                    dtype = torch.float32
+
+                tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True, local_files_only=True)
+                # Tokenize the fixed prompt parts now, so queries only tokenize their own text
+                for instruction_key in SYSTEM_INSTRUCTIONS:
+                    _prompt_scaffold_token_count(instruction_key, tokenizer)
+                rag_models["tokenizer"] = tokenizer
+                llm_model = AutoModelForSeq2SeqLM.from_pretrained(
+                    model_name,
+                    torch_dtype=dtype,
+                    local_files_only=True
+                ).to(device)
+                llm_model.eval()
+                if device == "cuda" and hasattr(torch, "compile"):
+                    # generate() calls forward once per decoded token with a growing KV cache,
+                    # so compile forward with dynamic shapes instead of recompiling per length
+                    llm_model.forward = torch.compile(llm_model.forward, dynamic=True)
+                # Set last: it is the field the unlocked check above reads
+                rag_models["llm_model"] = llm_model
+                
+                print(f"Time to load RAG Language Model: {time.time() - start_time:.4f} seconds.")
+            except Exception as e:
+                print(f"CRITICAL ERROR: Failed to lazy load RAG Language Model: {e}")
+                raise
+
+QUESTION_ANSWER_SCAFFOLD = "\n\nQuestion: \nAnswer:"
+
+@lru_cache(maxsize=32)
+def _prompt_scaffold_token_count(instruction_key: str, tokenizer) -> int:
+    """Token count of everything in the prompt except the context and the query: the system
+    instruction plus the Question/Answer labels. Computed once per (instruction, tokenizer)."""
+    system_instruction = SYSTEM_INSTRUCTIONS.get(instruction_key, SYSTEM_INSTRUCTIONS["default"])
+    return len(tokenizer.encode(system_instruction, add_special_tokens=False)) + len(tokenizer.encode(QUESTION_ANSWER_SCAFFOLD, add_special_tokens=False))
 
 def format_context_for_llm(retrieved_chunks: List[Dict], query: str, tokenizer, max_tokens_for_context: int, instruction_key: str = "default"):
     system_instruction = SYSTEM_INSTRUCTIONS.get(instruction_key, SYSTEM_INSTRUCTIONS["default"])
-    base_prompt_estimate = len(tokenizer.encode(system_instruction + "\n\nQuestion: " + query + "\nAnswer:", add_special_tokens=False))
+    base_prompt_estimate = _prompt_scaffold_token_count(instruction_key, tokenizer) + len(tokenizer.encode(query, add_special_tokens=False))
     available_context_tokens = max_tokens_for_context - base_prompt_estimate - 50
-    context_parts = ["Context:"]
-    current_context_tokens = 0
-    for chunk in sorted(retrieved_chunks, key=lambda x: x.get('score', 0), reverse=True):
-        chunk_text = f"Document (ID: {chunk.get('doc_id', 'N/A')}): {chunk.get('text', '')}"
-        chunk_tokens = tokenizer.encode(chunk_text, add_special_tokens=False)
-        if current_context_tokens + len(chunk_tokens) <= available_context_tokens:
-            context_parts.append(chunk_text)
-            current_context_tokens += len(chunk_tokens)
-        else:
-            break
-    full_context = "\n\n".join(context_parts)
+    sorted_chunks = sorted(retrieved_chunks, key=lambda x: x.get('score', 0), reverse=True)
+    texts = [f"Document (ID: {c.get('doc_id', 'N/A')}): {c.get('text', '')}" for c in sorted_chunks]
+    fitting_chunks = 0
+    if texts:
+        # One batched tokenizer call; chunks are added greedily until the first one that doesn't fit
+        lengths = np.asarray(tokenizer(texts, add_special_tokens=False, return_length=True)["length"])
+        fitting_chunks = int(np.searchsorted(np.cumsum(lengths), available_context_tokens, side='right'))
+    full_context = "\n\n".join(["Context:"] + texts[:fitting_chunks])
     return f"{system_instruction}\n\n{full_context}\n\nQuestion: {query}\nAnswer:"
 
-def generate_response(context: str) -> str:
+def generate_response(context: str, streamer=None) -> str:
+    """Generates the answer for a prompt. With a transformers streamer, text is also pushed to it as it is decoded."""
     _load_rag_model_if_needed()
     try:
         inputs = rag_models["tokenizer"](context, return_tensors="pt", max_length=rag_models["max_context_length"], truncation=True, padding=True)
         device = rag_models["llm_model"].device
-        with torch.no_grad():
+        with _generate_lock, torch.inference_mode():
             outputs = rag_models["llm_model"].generate(
                 input_ids=inputs.input_ids.to(device),
                 attention_mask=inputs.attention_mask.to(device),
                 max_new_tokens=rag_models["max_response_length"],
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9
+                do_sample=False,
+                num_beams=1,
+                use_cache=True,
+                streamer=streamer
             )
         return rag_models["tokenizer"].decode(outputs[0], skip_special_tokens=True)
     except Exception as e:
         print(f"ERROR (rag_service): Failed to generate response: {e}")
+        if streamer is not None:
+            # generate() only closes the stream on success; close it so the reader doesn't wait forever
+            streamer.on_finalized_text("Error generating response.", stream_end=True)
         return "Error generating response."
 
-def rag_query(query: str, dataset: str, top_k: int = 5, similarity_threshold: float = 0.7, instruction_key: str = "default") -> Dict:
-    start_total_time = time.time()
+def stream_response(context: str) -> Iterator[str]:
+    """Yields the answer for a prompt piece by piece while generation runs in a background thread."""
+    from transformers import TextIteratorStreamer
+    _load_rag_model_if_needed()
+    streamer = TextIteratorStreamer(rag_models["tokenizer"], skip_prompt=True, skip_special_tokens=True)
+    threading.Thread(target=generate_response, args=(context,), kwargs={"streamer": streamer}, daemon=True).start()
+    yield from streamer
+
+def _prepare_rag_context(query: str, dataset: str, top_k: int, similarity_threshold: float, instruction_key: str):
+    """Retrieves the chunks for a query and builds the LLM prompt from them. Returns (retrieved_chunks, prompt)."""
     _load_rag_model_if_needed()
-    
-    start_time_retrieval = time.time()
+
+    start_time_retrieval = time.perf_counter()
     retrieved_chunks = faiss_service.search_faiss(query=query, dataset=dataset, top_k=top_k, similarity_threshold=similarity_threshold)
-    print(f"Time for RAG retrieval (FAISS search): {time.time() - start_time_retrieval:.4f} seconds")
+    logger.debug("Time for RAG retrieval (FAISS search): %.4f seconds", time.perf_counter() - start_time_retrieval)
 
-    start_time_format_context = time.time()
+    start_time_format_context = time.perf_counter()
     context = format_context_for_llm(retrieved_chunks, query, rag_models["tokenizer"], rag_models["max_context_length"], instruction_key=instruction_key)
-    print(f"Time for RAG context formatting: {time.time() - start_time_format_context:.4f} seconds")
+    logger.debug("Time for RAG context formatting: %.4f seconds", time.perf_counter() - start_time_format_context)
+    return retrieved_chunks, context
 
-    start_time_generate_response = time.time()
+def rag_query(query: str, dataset: str, top_k: int = 5, similarity_threshold: float = 0.7, instruction_key: str = "default") -> Dict:
+    start_total_time = time.perf_counter()
+    retrieved_chunks, context = _prepare_rag_context(query, dataset, top_k, similarity_threshold, instruction_key)
+
+    start_time_generate_response = time.perf_counter()
     response = generate_response(context)
-    print(f"Time for RAG response generation: {time.time() - start_time_generate_response:.4f} seconds")
+    logger.debug("Time for RAG response generation: %.4f seconds", time.perf_counter() - start_time_generate_response)
 
-    print(f"Total RAG query execution time: {time.time() - start_total_time:.4f} seconds")
+    logger.debug("Total RAG query execution time: %.4f seconds", time.perf_counter() - start_total_time)
     return {
         "query": query,
         "dataset": dataset,
         "retrieved_chunks": retrieved_chunks,
         "generated_response": response,
-        "metadata": {"processing_time": time.time() - start_total_time}
+        "metadata": {"processing_time": time.perf_counter() - start_total_time}
     }
 
-
+def rag_query_stream(query: str, dataset: str, top_k: int = 5, similarity_threshold: float = 0.7, instruction_key: str = "default"):
+    """Like rag_query, but returns (retrieved_chunks, iterator over the answer text as it is generated)."""
+    retrieved_chunks, context = _prepare_rag_context(query, dataset, top_k, similarity_threshold, instruction_key)
+    return retrieved_chunks, stream_response(context)
@@ -1,26 +1,45 @@
+import logging
+import os
+import sys
+import pickle
 import string
 import nltk
-from nltk.corpus import stopwords
+from nltk.corpus import stopwords, wordnet
 from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
+from functools import lru_cache
 import re
 import traceback
 import time
 
+logger = logging.getLogger(__name__)
+
 stop_words = None
 lemmatizer = None
 punct_table = None
+# Surface token -> noun lemma, precomputed offline for the corpus vocabulary (see __main__)
+lemma_map = None
+
+LEMMA_MAP_PATH = os.path.join(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')), 'lemma_map.pkl')
+
+_DIGIT_RE = re.compile(r"\d+")
+# Punctuation and digits are already stripped, so word characters are letters
+_TOKEN_RE = re.compile(r"\w+")
 
 def initialize_text_processor():
-    global stop_words, lemmatizer, punct_table
+    global stop_words, lemmatizer, punct_table, lemma_map
     start_time = time.time()
     try:
         if stop_words is None:
             stop_words = set(stopwords.words("english"))
         if lemmatizer is None:
+            # Load WordNet eagerly: NLTK's lazy corpus loader is not safe when two
+            # threads (e.g. hybrid search's TF-IDF and embedding stages) hit it first
+            wordnet.ensure_loaded()
             lemmatizer = WordNetLemmatizer()
         if punct_table is None:
             punct_table = str.maketrans("", "", string.punctuation)
+        if lemma_map is None:
+            lemma_map = _load_lemma_map()
 
         print(f"Time to initialize text processor: {time.time() - start_time:.4f} seconds.")
     except Exception as e:
@@ -28,6 +47,30 @@ def initialize_text_processor():
         traceback.print_exc()
         raise
 
+def _load_lemma_map():
+    """Loads the precomputed lemma map, or an empty one so every token goes through the live lemmatizer."""
+    if not os.path.exists(LEMMA_MAP_PATH):
+        print(f"WARNING (text_processing_service): {LEMMA_MAP_PATH} not found; lemmatizing every token with WordNet.")
+        return {}
+    with open(LEMMA_MAP_PATH, 'rb') as f:
+        return pickle.load(f)
+
+def build_lemma_map(texts):
+    """Maps every distinct non-stopword token of texts, tokenized as clean_text does, to its noun lemma."""
+    if stop_words is None or lemmatizer is None or punct_table is None:
+        initialize_text_processor()
+    tokens = set()
+    for text in texts:
+        if isinstance(text, str):
+            tokens.update(_TOKEN_RE.findall(_DIGIT_RE.sub("", text.lower().translate(punct_table))))
+    tokens -= stop_words
+    return {token: lemmatizer.lemmatize(token, pos="n") for token in tokens}
+
+@lru_cache(maxsize=200_000)
+def _lemmatize(word):
+    """Noun lemma of a token, memoized since queries share most of their vocabulary."""
+    return lemmatizer.lemmatize(word, pos="n")
+
 def clean_text(text):
     if stop_words is None or lemmatizer is None or punct_table is None:
         initialize_text_processor()
@@ -35,22 +78,15 @@ def clean_text(text):
     if not isinstance(text, str):
         return ""
     
-    start_total_clean = time.time()
-    
-    text = text.lower()
-    text = text.translate(punct_table)
-    text = re.sub(r"\d+", "", text)
+    start_total_clean = time.perf_counter()
     
-    tokens = word_tokenize(text)
-    
-    cleaned_tokens = []
-    for word in tokens:
-        if word not in stop_words:
-            cleaned_tokens.append(lemmatizer.lemmatize(word, pos="n")) 
-            
-    final_cleaned_text = " ".join(cleaned_tokens)
-
-    print(f"Time for text cleaning: {time.time() - start_total_clean:.4f} seconds")
+    text = _DIGIT_RE.sub("", text.lower().translate(punct_table))
+    tokens = _TOKEN_RE.findall(text)
+
+    # Lemmas are never empty, so a miss falls through to the live lemmatizer
+    final_cleaned_text = " ".join([lemma_map.get(word) or _lemmatize(word) for word in tokens if word not in stop_words])
+
+    logger.debug("Time for text cleaning: %.4f seconds", time.perf_counter() - start_total_clean)
     return final_cleaned_text
 
 def custom_tokenizer(text):
@@ -58,4 +94,19 @@ def custom_tokenizer(text):
         return []
     return text.split()
 
-
+if __name__ == '__main__':
+    # Offline build from the indexed corpora and the query sets: python -m app.text_processing_service
+    import app.data_loader_utils as data_loader_utils
+    import app.document_service as document_service
+    from app.file_utils import atomic_output_path
+    start_time = time.time()
+    document_service.initialize_document_data(document_service.PROJECT_ROOT)
+    texts = []
+    for dataset_name in sys.argv[1:] or list(document_service.DATASETS):
+        texts.extend(document_service.get_all_documents_for_faiss(dataset_name).values())
+    texts.extend(data_loader_utils.load_antique_queries().values())
+    texts.extend(data_loader_utils.load_webis_queries().values())
+    new_lemma_map = build_lemma_map(texts)
+    with atomic_output_path(LEMMA_MAP_PATH) as tmp_path, open(tmp_path, 'wb') as f:
+        pickle.dump(new_lemma_map, f, protocol=pickle.HIGHEST_PROTOCOL)
+    print(f"Time to build lemma map with {len(new_lemma_map)} tokens: {time.time() - start_time:.4f} seconds")
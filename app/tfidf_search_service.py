@@ -1,10 +1,12 @@
+import logging
 import os
 import sys
 import joblib
 import time
+import threading
 import traceback
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 import numpy as np
 from scipy.sparse import csr_matrix
 
@@ -18,34 +20,90 @@ if PROJECT_ROOT not in sys.path:
 # Import the service modules directly
 import app.document_service as document_service
 import app.text_processing_service as text_processing_service
+from app.file_utils import atomic_output_path
+
+logger = logging.getLogger(__name__)
 
 # --- Configuration Constants ---
 TFIDF_OUTPUT_BASE_DIR = 'TF_IDF' 
 
+# Serializes first loads: hybrid search runs TF-IDF on several worker threads at once
+_load_lock = threading.Lock()
+
 # --- Global storage for loaded models/data ---
 global_loaded_data = {
     "antique": {
-        "vectorizer": None, "tfidf_matrix": None
+        "vectorizer": None, "tfidf_matrix": None, "doc_ids": None
     },
     "webis": {
-        "vectorizer": None, "tfidf_matrix": None
+        "vectorizer": None, "tfidf_matrix": None, "doc_ids": None
     }
 }
 
 # --- Data Loading Functions ---
-def _load_tfidf_data_internal(dataset_name):
-    start_time = time.time()
-    
+def _load_vectorizer(dataset_name):
+    """Loads the fitted vectorizer, dropping stop_words_ when the installed scikit-learn still keeps it."""
     vectorizer_path = os.path.join(PROJECT_ROOT, TFIDF_OUTPUT_BASE_DIR, dataset_name, f'{dataset_name}_tfidf_vectorizer.joblib')
-    matrix_path = os.path.join(PROJECT_ROOT, TFIDF_OUTPUT_BASE_DIR, dataset_name, f'{dataset_name}_tfidf_matrix.npz') 
-    
     vectorizer = joblib.load(vectorizer_path)
-    
-    loaded_npz = np.load(matrix_path)
-    tfidf_matrix = csr_matrix((loaded_npz['data'], loaded_npz['indices'], loaded_npz['indptr']), shape=loaded_npz['shape'])
+    if hasattr(vectorizer, "stop_words_"):
+        # Older scikit-learn lists every term dropped by min_df/max_df here, for introspection only
+        vectorizer.stop_words_ = None
+    return vectorizer
+
+def _load_tfidf_matrix(dataset_name, vectorizer):
+    """Memory-maps the CSR arrays of the TF-IDF matrix, extracting them from the .npz on first use."""
+    dataset_dir = os.path.join(PROJECT_ROOT, TFIDF_OUTPUT_BASE_DIR, dataset_name)
+    matrix_path = os.path.join(dataset_dir, f'{dataset_name}_tfidf_matrix.npz')
+    # np.load cannot memory-map members of an .npz archive, so each array gets its own .npy
+    array_paths = {name: os.path.join(dataset_dir, f'{dataset_name}_tfidf_{name}.npy') for name in ('data', 'indices', 'indptr', 'shape')}
+
+    # shape is written last, so its presence and mtime vouch for the whole set
+    needs_conversion = not all(os.path.exists(path) for path in array_paths.values()) or (
+        os.path.exists(matrix_path) and os.path.getmtime(matrix_path) > os.path.getmtime(array_paths['shape'])
+    )
+    if needs_conversion:
+        loaded_npz = np.load(matrix_path)
+        tfidf_matrix = csr_matrix((loaded_npz['data'], loaded_npz['indices'], loaded_npz['indptr']), shape=loaded_npz['shape'])
+        if vectorizer.norm != 'l2':
+            # Search scores with a plain dot product, which is only cosine similarity for unit rows
+            print(f"WARNING (tfidf_search_service): Vectorizer for {dataset_name} uses norm={vectorizer.norm!r}; L2-normalizing the matrix rows.")
+            tfidf_matrix = normalize(tfidf_matrix, norm='l2', copy=False)
+        arrays = {
+            'data': tfidf_matrix.data,
+            'indices': tfidf_matrix.indices,
+            'indptr': tfidf_matrix.indptr,
+            'shape': np.asarray(tfidf_matrix.shape, dtype=np.int64),
+        }
+        try:
+            # Drop the old marker first, so an interrupted conversion is redone on the next load
+            if os.path.exists(array_paths['shape']):
+                os.remove(array_paths['shape'])
+            for name, array in arrays.items():
+                with atomic_output_path(array_paths[name]) as tmp_path:
+                    np.save(tmp_path, array)
+        except OSError as e:
+            print(f"WARNING (tfidf_search_service): Could not save TF-IDF arrays for {dataset_name}, keeping the matrix in RAM: {e}")
+            return tfidf_matrix
+
+    data, indices, indptr = (np.load(array_paths[name], mmap_mode='r') for name in ('data', 'indices', 'indptr'))
+    shape = tuple(int(dim) for dim in np.load(array_paths['shape']))
+    return csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+def _load_tfidf_data_internal(dataset_name):
+    start_time = time.time()
+    vectorizer = _load_vectorizer(dataset_name)
+    tfidf_matrix = _load_tfidf_matrix(dataset_name, vectorizer)
+
+    # Matrix row -> doc_id; the corpus is static, so this is read from the DB once
+    doc_ids = np.asarray(document_service.load_all_doc_ids_from_db(dataset_name), dtype=object)
+    # Raise instead of caching a bad list: the load is retried on the next query
+    if len(doc_ids) == 0:
+        raise RuntimeError(f"Could not load document IDs for {dataset_name} from database.")
+    if len(doc_ids) != tfidf_matrix.shape[0]:
+        raise RuntimeError(f"{len(doc_ids)} document IDs for {dataset_name} do not match the {tfidf_matrix.shape[0]} TF-IDF matrix rows.")
     
     print(f"Time to load TF-IDF data for {dataset_name}: {time.time() - start_time:.4f} seconds")
-    return vectorizer, tfidf_matrix
+    return vectorizer, tfidf_matrix, doc_ids
 
 # --- Initialization Function (Public) ---
 def initialize_tfidf_models(project_root_path):
@@ -54,19 +112,25 @@ def initialize_tfidf_models(project_root_path):
 
 # --- TF-IDF Search Function (Public) ---
 def tfidf_search(query_text, dataset_name, top_n=10, top_k_inverted_index=None):
-    start_total_time = time.time()
+    start_total_time = time.perf_counter()
 
     dataset_data = global_loaded_data.get(dataset_name)
     
     if not dataset_data or dataset_data["vectorizer"] is None:
-        try:
-            vectorizer, tfidf_matrix = _load_tfidf_data_internal(dataset_name)
-            global_loaded_data[dataset_name]["vectorizer"] = vectorizer
-            global_loaded_data[dataset_name]["tfidf_matrix"] = tfidf_matrix
-        except Exception as e:
-            print(f"ERROR (tfidf_search_service): Failed to load TF-IDF models for {dataset_name.upper()} on demand: {e}")
-            traceback.print_exc()
-            raise RuntimeError(f"TF-IDF models for {dataset_name} could not be loaded.")
+        with _load_lock:
+            dataset_data = global_loaded_data.get(dataset_name)
+            # Another thread may have finished the load while this one waited
+            if not dataset_data or dataset_data["vectorizer"] is None:
+                try:
+                    vectorizer, tfidf_matrix, doc_ids = _load_tfidf_data_internal(dataset_name)
+                    global_loaded_data[dataset_name]["tfidf_matrix"] = tfidf_matrix
+                    global_loaded_data[dataset_name]["doc_ids"] = doc_ids
+                    # Set last: it is the field the unlocked check above reads
+                    global_loaded_data[dataset_name]["vectorizer"] = vectorizer
+                except Exception as e:
+                    print(f"ERROR (tfidf_search_service): Failed to load TF-IDF models for {dataset_name.upper()} on demand: {e}")
+                    traceback.print_exc()
+                    raise RuntimeError(f"TF-IDF models for {dataset_name} could not be loaded.")
         dataset_data = global_loaded_data.get(dataset_name)
 
     if not dataset_data or dataset_data["vectorizer"] is None: # Double check after attempted load
@@ -74,76 +138,62 @@ def tfidf_search(query_text, dataset_name, top_n=10, top_k_inverted_index=None):
 
     vectorizer = dataset_data["vectorizer"]
     tfidf_matrix = dataset_data["tfidf_matrix"]
-    
-    doc_ids = document_service.load_all_doc_ids_from_db(dataset_name)
-    if not doc_ids:
+    doc_ids = dataset_data["doc_ids"]
+    if doc_ids is None or len(doc_ids) == 0:
         raise RuntimeError(f"Could not load document IDs for {dataset_name} from database.")
 
     # Step 1: Preprocess query
-    start_time_query_proc = time.time()
+    start_time_query_proc = time.perf_counter()
     processed_query = text_processing_service.clean_text(query_text)
-    print(f"Time for query preprocessing (TF-IDF search): {time.time() - start_time_query_proc:.4f} seconds")
+    logger.debug("Time for query preprocessing (TF-IDF search): %.4f seconds", time.perf_counter() - start_time_query_proc)
 
     if not processed_query:
         return []
 
     # Step 2: Transform query into TF-IDF vector
-    start_time_transform = time.time()
+    start_time_transform = time.perf_counter()
     query_vector = vectorizer.transform([processed_query])
-    print(f"Time for query transformation (TF-IDF search): {time.time() - start_time_transform:.4f} seconds")
+    logger.debug("Time for query transformation (TF-IDF search): %.4f seconds", time.perf_counter() - start_time_transform)
 
-    # Step 3: Calculate cosine similarity
-    start_time_cosine_sim = time.time()
-    similarities = cosine_similarity(query_vector, tfidf_matrix).flatten()
-    print(f"Time for cosine similarity calculation (TF-IDF search): {time.time() - start_time_cosine_sim:.4f} seconds")
+    # Step 3: Calculate cosine similarity (rows and query are L2-normalized, so a dot product suffices)
+    start_time_cosine_sim = time.perf_counter()
+    if vectorizer.norm != 'l2':
+        query_vector = normalize(query_vector, norm='l2')
+    similarities = tfidf_matrix @ query_vector.toarray().ravel()
+    logger.debug("Time for cosine similarity calculation (TF-IDF search): %.4f seconds", time.perf_counter() - start_time_cosine_sim)
 
     # Step 4: Get top N results
-    start_time_top_n = time.time()
-    if top_k_inverted_index and top_k_inverted_index < len(similarities):
-        top_candidate_indices = np.argpartition(similarities, -top_k_inverted_index)[-top_k_inverted_index:]
-        candidate_similarities = similarities[top_candidate_indices]
-        candidate_doc_ids = [doc_ids[i] for i in top_candidate_indices] 
-        
-        sorted_candidate_indices = np.argsort(candidate_similarities)[::-1]
-        final_indices = sorted_candidate_indices[:top_n]
-        
-        scored_docs = []
-        for idx in final_indices:
-            scored_docs.append((candidate_doc_ids[idx], candidate_similarities[idx]))
+    start_time_top_n = time.perf_counter()
+    num_results = min(top_n, top_k_inverted_index or top_n, len(similarities))
+    if num_results < len(similarities):
+        top_indices = np.argpartition(-similarities, num_results)[:num_results]
     else:
-        top_indices = similarities.argsort()[::-1][:top_n]
-        scored_docs = []
-        for idx in top_indices:
-            scored_docs.append((doc_ids[idx], similarities[idx]))
+        top_indices = np.arange(len(similarities))
+    top_indices = top_indices[np.argsort(-similarities[top_indices])]
+    # One C-level pass each instead of boxing ids and scores row by row
+    top_doc_ids = doc_ids[top_indices].tolist()
+    top_scores = similarities[top_indices].tolist()
 
-    print(f"Time for top-N selection (TF-IDF search): {time.time() - start_time_top_n:.4f} seconds")
+    logger.debug("Time for top-N selection (TF-IDF search): %.4f seconds", time.perf_counter() - start_time_top_n)
 
     # Step 5: Retrieve snippets using document_service
-    start_time_snippets = time.time()
-    doc_ids_for_snippets = [doc_id for doc_id, score in scored_docs]
-    
+    start_time_snippets = time.perf_counter()
     snippets_map = {}
-    if doc_ids_for_snippets:
+    if top_doc_ids:
         try:
-            snippets_map = document_service.get_document_contents_batch(dataset_name, doc_ids_for_snippets)
+            snippets_map = document_service.get_document_snippets_batch(dataset_name, top_doc_ids)
         except Exception as e:
             print(f"WARNING: Could not fetch snippets from document service in batch: {e}")
             traceback.print_exc()
-    print(f"Time for batch snippet retrieval (TF-IDF search): {time.time() - start_time_snippets:.4f} seconds")
-
-    final_results = []
-    for doc_id, score in scored_docs:
-        doc_content = snippets_map.get(doc_id, "")
-        snippet = doc_content[:150] + "..." if len(doc_content) > 150 else doc_content
-        
-        final_results.append({
-            "doc_id": doc_id,
-            "score": float(score),
-            "snippet": snippet
-        })
+    logger.debug("Time for batch snippet retrieval (TF-IDF search): %.4f seconds", time.perf_counter() - start_time_snippets)
+
+    final_results = [
+        {"doc_id": doc_id, "score": score, "snippet": snippets_map.get(doc_id, "")}
+        for doc_id, score in zip(top_doc_ids, top_scores)
+    ]
     
-    end_total_time = time.time()
-    print(f"Total TF-IDF search execution time: {end_total_time - start_total_time:.4f} seconds")
+    end_total_time = time.perf_counter()
+    logger.debug("Total TF-IDF search execution time: %.4f seconds", end_total_time - start_total_time)
 
     return final_results
 
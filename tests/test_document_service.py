@@ -0,0 +1,50 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import app.document_service as document_service
+
+try:
+    import app.data_loader_utils as data_loader_utils
+except ImportError:  # pandas is not installed
+    data_loader_utils = None
+
+# Deliberately not in sorted order, so an index-ordered scan would reorder them
+INSERTED_IDS = ["d3", "a10", "z1", "b2", "a1"]
+
+
+class LoadAllDocIdsOrderTest(unittest.TestCase):
+    """Doc ids must come back in insertion order: TF-IDF matrix row i belongs to doc_ids[i]."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp_dir.name, 'IR_project.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE cleaned_antique (id TEXT, text TEXT)")
+        conn.executemany("INSERT INTO cleaned_antique (id, text) VALUES (?, ?)", [(doc_id, f"text {doc_id}") for doc_id in INSERTED_IDS])
+        conn.commit()
+        conn.close()
+        # Creates the covering id index that previously made the scan return sorted ids
+        document_service.initialize_document_data(self.tmp_dir.name)
+        self.db_path = db_path
+
+    def tearDown(self):
+        document_service.close_connections()
+        self.tmp_dir.cleanup()
+
+    def test_document_service_keeps_insertion_order(self):
+        self.assertEqual(document_service.load_all_doc_ids_from_db("antique"), INSERTED_IDS)
+
+    @unittest.skipIf(data_loader_utils is None, "pandas is not installed")
+    def test_data_loader_utils_keeps_insertion_order(self):
+        original_db_path = data_loader_utils.DB_PATH
+        data_loader_utils.DB_PATH = self.db_path
+        try:
+            self.assertEqual(data_loader_utils.load_all_doc_ids_from_db("antique"), INSERTED_IDS)
+        finally:
+            data_loader_utils.DB_PATH = original_db_path
+
+
+if __name__ == '__main__':
+    unittest.main()